@@ -14,6 +14,13 @@ class Alias:
         self.file_path = "data/alias/aliases.json"
         self.aliases = dataIO.load_json(self.file_path)
         self.remove_old()
+        self.bot.dispatch_table.register("aliases", self.server_aliases)
+
+    def __unload(self):
+        self.bot.dispatch_table.unregister("aliases")
+
+    def server_aliases(self, sid):
+        return self.aliases.get(sid, {})
 
     @commands.group(pass_context=True, no_pm=True)
     async def alias(self, ctx):
@@ -46,6 +53,7 @@ class Alias:
         if command not in self.bot.commands:
             self.aliases[server.id][command] = to_execute
             dataIO.save_json(self.file_path, self.aliases)
+            self.bot.dispatch_table.invalidate(server.id)
             await self.bot.say("Alias '{}' added.".format(command))
         else:
             await self.bot.say("Cannot add '{}' because it's a real bot "
@@ -89,6 +97,7 @@ class Alias:
         if server.id in self.aliases:
             self.aliases[server.id].pop(command, None)
             dataIO.save_json(self.file_path, self.aliases)
+            self.bot.dispatch_table.invalidate(server.id)
         await self.bot.say("Alias '{}' deleted.".format(command))
 
     @alias.command(name="list", pass_context=True, no_pm=True)
@@ -114,21 +123,18 @@ class Alias:
         if len(message.content) < 2 or message.channel.is_private:
             return
 
-        msg = message.content
-        server = message.server
-        prefix = self.get_prefix(server, msg)
+        dispatch = self.bot.dispatch_table.classify(message)
 
-        if not prefix:
+        if dispatch is None or not dispatch.prefix:
             return
 
-        if server.id in self.aliases and user_allowed(message):
-            alias = self.first_word(msg[len(prefix):]).lower()
-            if alias in self.aliases[server.id]:
-                new_command = self.aliases[server.id][alias]
-                args = message.content[len(prefix + alias):]
-                new_message = deepcopy(message)
-                new_message.content = prefix + new_command + args
-                await self.bot.process_commands(new_message)
+        if dispatch.alias is not None and user_allowed(message):
+            prefix = dispatch.prefix
+            alias = self.first_word(message.content[len(prefix):])
+            args = message.content[len(prefix + alias):]
+            new_message = deepcopy(message)
+            new_message.content = prefix + dispatch.alias + args
+            await self.bot.process_commands(new_message)
 
     def part_of_existing_command(self, alias, server):
         '''Command or alias'''
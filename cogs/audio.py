@@ -1,10 +1,10 @@
 import discord
 from discord.ext import commands
-import threading
 import os
 from random import shuffle, choice
 from cogs.utils.dataIO import dataIO
 from cogs.utils import checks
+from cogs.utils import mixer
 from cogs.utils.chat_formatting import pagify, escape
 from urllib.parse import urlparse
 from __main__ import send_cmd_help, settings
@@ -19,7 +19,12 @@ import time
 import inspect
 import subprocess
 import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
 
 __author__ = "tekulvw"
 __version__ = "0.1.1"
@@ -41,6 +46,14 @@ except:  # Missing opus
 else:
     opus = True
 
+METADATA_PATH = "data/audio/metadata.json"
+METADATA_TTL = 7 * 24 * 3600  # Seconds before a cached lookup is redone
+METADATA_MAX_ENTRIES = 5000
+QUEUE_LIST_LENGTH = 15  # Songs shown by queue list
+QUEUE_LIST_PAGE = 5  # Songs resolved before the queue list is (re)sent
+QUEUE_RETRY_DELAY = 1  # Seconds before a queue that didn't start is retried
+TRANSCODE_MEASURE_EVERY = 20  # Transcodes per decoding CPU measurement
+
 youtube_dl_options = {
     'source_address': '0.0.0.0',
     'format': 'bestaudio/best',
@@ -242,37 +255,38 @@ class Playlist:
             return None
 
 
-class Downloader(threading.Thread):
+class Downloader:
     def __init__(self, url, max_duration=None, download=False,
-                 cache_path="data/audio/cache", *args, **kwargs):
-        super().__init__(*args, **kwargs)
+                 cache_path="data/audio/cache"):
         self.url = url
         self.max_duration = max_duration
-        self.done = threading.Event()
+        self.cache_path = cache_path
         self.song = None
         self._download = download
-        self.hit_max_length = threading.Event()
+        self.hit_max_length = False
         self._yt = None
         self.error = None
 
     def run(self):
+        """Blocking, meant to be run by the DownloadService's pool"""
         try:
-            self.get_info()
+            if self.song is None:
+                self.get_info()
             if self._download:
                 self.download()
         except youtube_dl.utils.DownloadError as e:
             self.error = str(e)
         except MaximumLength:
-            self.hit_max_length.set()
+            self.hit_max_length = True
         except OSError as e:
             log.warning("An operating system error occurred while downloading URL '{}':\n'{}'".format(self.url, str(e)))
-        self.done.set()
+        return self
 
     def download(self):
         self.duration_check()
 
-        if not os.path.isfile('data/audio/cache' + self.song.id):
-            video = self._yt.extract_info(self.url)
+        if not os.path.isfile(os.path.join(self.cache_path, self.song.id)):
+            video = self._youtube_dl().extract_info(self.url)
             self.song = Song(**video)
 
     def duration_check(self):
@@ -284,23 +298,460 @@ class Downloader(threading.Thread):
                 self.song.id, self.song.duration, self.max_duration))
 
     def get_info(self):
-        if self._yt is None:
-            self._yt = youtube_dl.YoutubeDL(youtube_dl_options)
+        yt = self._youtube_dl()
         if "[SEARCH:]" not in self.url:
-            video = self._yt.extract_info(self.url, download=False,
-                                          process=False)
+            video = yt.extract_info(self.url, download=False, process=False)
         else:
             self.url = self.url[9:]
-            yt_id = self._yt.extract_info(
+            yt_id = yt.extract_info(
                 self.url, download=False)["entries"][0]["id"]
             # Should handle errors here ^
             self.url = "https://youtube.com/watch?v={}".format(yt_id)
-            video = self._yt.extract_info(self.url, download=False,
-                                          process=False)
+            video = yt.extract_info(self.url, download=False, process=False)
 
         if(video is not None):
+            if video.get("entries") is not None:
+                # Playlist entries are fetched lazily, page by page. Do it
+                #   here rather than when the event loop iterates them
+                video["entries"] = list(video["entries"])
             self.song = Song(**video)
 
+    def _youtube_dl(self):
+        if self._yt is None:
+            self._yt = youtube_dl.YoutubeDL(youtube_dl_options)
+        return self._yt
+
+
+class MetadataCache:
+    """youtube-dl lookups persisted to disk, with TTL and LRU eviction
+
+    Songs are stored by id, with every URL / search that resolved to
+    them pointing at that id. What's particular to a URL, where it
+    starts and ends playing, is stored with it. Playlists are stored as
+    their list of song URLs. Only meant to be used from the event loop."""
+
+    SONG_KEYS = ("title", "duration", "id", "webpage_url")
+    URL_KEYS = ("start_time", "end_time")
+
+    def __init__(self, path, max_entries=METADATA_MAX_ENTRIES,
+                 ttl=METADATA_TTL):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.dirty = False
+        data = dataIO.load_json(path)
+        by_access = lambda item: item[1]["accessed"]
+        self.songs = collections.OrderedDict(
+            sorted(data.get("SONGS", {}).items(), key=by_access))
+        self.playlists = collections.OrderedDict(
+            sorted(data.get("PLAYLISTS", {}).items(), key=by_access))
+        self.urls = {}  # url: song id
+        for song_id, entry in self.songs.items():
+            for url in entry["urls"]:
+                self.urls[url] = song_id
+
+    def get_song(self, url):
+        song_id = self.urls.get(url)
+        entry = self._get(self.songs, song_id)
+        if entry is None:
+            return None
+        info = {k: entry[k] for k in self.SONG_KEYS}
+        info.update(entry["urls"][url])
+        return Song(**info)
+
+    def put_song(self, url, song):
+        now = time.time()
+        entry = self.songs.get(song.id)
+        if entry is None:
+            entry = {k: getattr(song, k) for k in self.SONG_KEYS}
+            entry["urls"] = {}  # url: {"start_time", "end_time"}
+            self.songs[song.id] = entry
+        entry["fetched"] = entry["accessed"] = now
+        entry["urls"][url] = {k: getattr(song, k) for k in self.URL_KEYS}
+        self.urls[url] = song.id
+        if song.webpage_url and song.webpage_url not in entry["urls"]:
+            # The song's own page plays from the start
+            entry["urls"][song.webpage_url] = dict.fromkeys(self.URL_KEYS)
+            self.urls[song.webpage_url] = song.id
+        self.songs.move_to_end(song.id)
+        self._evict()
+        self.dirty = True
+
+    def get_playlist(self, url):
+        entry = self._get(self.playlists, url)
+        if entry is None:
+            return None
+        return list(entry["songs"])
+
+    def put_playlist(self, url, songs):
+        now = time.time()
+        self.playlists[url] = {"songs": songs, "fetched": now,
+                               "accessed": now}
+        self.playlists.move_to_end(url)
+        self._evict()
+        self.dirty = True
+
+    def save(self):
+        dataIO.save_json(self.path, {"SONGS": self.songs,
+                                     "PLAYLISTS": self.playlists})
+        self.dirty = False
+
+    def _get(self, entries, key):
+        entry = entries.get(key)
+        if entry is not None and time.time() - entry["fetched"] > self.ttl:
+            self._remove(entries, key)
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        entry["accessed"] = time.time()
+        entries.move_to_end(key)
+        self.dirty = True
+        return entry
+
+    def _evict(self):
+        while len(self.songs) + len(self.playlists) > self.max_entries:
+            oldest = [e for e in (self.songs, self.playlists) if e]
+            entries = min(oldest, key=lambda e: next(iter(e.values()))
+                          ["accessed"])
+            self._remove(entries, next(iter(entries)))
+
+    def _remove(self, entries, key):
+        entry = entries.pop(key)
+        for url in entry.get("urls", []):
+            if self.urls.get(url) == key:
+                del self.urls[url]
+
+
+class CacheIndex:
+    """In-memory index of the audio cache folder
+
+    Tracks size, last access and play count of each file so the cache
+    never has to be listed again, and evicts the least recently played
+    files first."""
+
+    def __init__(self, path):
+        self.path = path
+        self.files = {}  # name: {"size", "accessed", "plays"}
+        self.size = 0  # bytes
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0  # bytes
+        self.rescan()
+
+    def rescan(self):
+        self.files = {}
+        self.size = 0
+        for name in os.listdir(self.path):
+            try:
+                stat = os.stat(os.path.join(self.path, name))
+            except OSError:
+                continue
+            if os.path.isdir(os.path.join(self.path, name)):
+                continue
+            self.files[name] = {"size": stat.st_size,
+                                "accessed": stat.st_mtime, "plays": 0,
+                                "opus": self._is_ogg(name)}
+            self.size += stat.st_size
+
+    def add(self, name):
+        try:
+            size = os.path.getsize(os.path.join(self.path, name))
+        except OSError:
+            return
+        old = self.files.get(name, {})
+        self.discard(name)
+        self.files[name] = {"size": size,
+                            "accessed": old.get("accessed", time.time()),
+                            "plays": old.get("plays", 0),
+                            "opus": self._is_ogg(name)}
+        self.size += size
+
+    def is_opus(self, name):
+        """True if the file has already been transcoded to Ogg/Opus"""
+        return self.files.get(name, {}).get("opus", False)
+
+    def _is_ogg(self, name):
+        try:
+            with open(os.path.join(self.path, name), "rb") as f:
+                return f.read(4) == b"OggS"
+        except OSError:
+            return False
+
+    def discard(self, name):
+        entry = self.files.pop(name, None)
+        if entry is not None:
+            self.size -= entry["size"]
+
+    def lookup(self, name):
+        """Returns True and marks the file as played if it's cached"""
+        entry = self.files.get(name)
+        if entry is not None and \
+                not os.path.isfile(os.path.join(self.path, name)):
+            self.discard(name)  # Deleted behind our back
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return False
+        self.hits += 1
+        entry["accessed"] = time.time()
+        entry["plays"] += 1
+        return True
+
+    def evict(self, target, keep=()):
+        """Deletes files, least recently played first, until the cache
+        is at most target bytes. Returns the bytes freed"""
+        freed = 0
+        candidates = sorted((n for n in self.files if n not in keep),
+                            key=lambda n: (self.files[n]["accessed"],
+                                           self.files[n]["plays"]))
+        for name in candidates:
+            if self.size <= target:
+                break
+            size = self.files[name]["size"]
+            try:
+                os.remove(os.path.join(self.path, name))
+            except FileNotFoundError:
+                pass
+            except OSError:
+                # Removing a file in use on Windows
+                continue
+            self.discard(name)
+            freed += size
+        self.evicted += freed
+        return freed
+
+
+class OpusTranscoder:
+    """Re-encodes cached songs, one at a time, into 48kHz stereo Ogg/Opus
+
+    The transcoded file replaces the original so the rest of the cache
+    logic is unaffected. Playing it back only needs ffmpeg to decode
+    Opus, with no resampling. For one in every TRANSCODE_MEASURE_EVERY
+    tracks the CPU time needed to decode the original and the Opus
+    version is measured."""
+
+    def __init__(self, loop, cache_index, player="ffmpeg"):
+        self.loop = loop
+        self.cache_index = cache_index
+        self.player = player
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self._pending = {}  # name: future
+        self.transcoded = 0
+        self.failed = 0
+        self.source_cpu = 0.0  # CPU seconds to decode the originals
+        self.opus_cpu = 0.0  # CPU seconds to decode the Opus versions
+        self.measured = 0
+        self._submitted = 0
+
+    def submit(self, name):
+        if name in self._pending or self.cache_index.is_opus(name):
+            return
+        measure = self._submitted % TRANSCODE_MEASURE_EVERY == 0
+        self._submitted += 1
+        fut = self.loop.run_in_executor(self.executor, self._transcode, name,
+                                        measure)
+        self._pending[name] = fut
+        fut.add_done_callback(lambda f: self._done(name, f))
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+    def _done(self, name, fut):
+        del self._pending[name]
+        if fut.cancelled():
+            return
+        if fut.exception() is not None:
+            log.exception("Transcoding {} failed".format(name),
+                          exc_info=fut.exception())
+            self.failed += 1
+            return
+        result = fut.result()
+        if result is None:
+            self.failed += 1
+            return
+        self.transcoded += 1
+        self.cache_index.add(name)
+        source_cpu, opus_cpu = result
+        if source_cpu is not None and opus_cpu is not None:
+            self.source_cpu += source_cpu
+            self.opus_cpu += opus_cpu
+            self.measured += 1
+
+    def _transcode(self, name, measure=False):
+        path = os.path.join(self.cache_index.path, name)
+        tmp = path + ".opus.tmp"
+        source_cpu = opus_cpu = None
+        if measure:
+            code, source_cpu = self._run(self._decode_args(path))
+        args = [self.player, "-y", "-i", path, "-vn", "-ac", "2",
+                "-ar", "48000", "-c:a", "libopus", "-b:a", "96k",
+                "-f", "ogg", tmp]
+        code, _ = self._run(args)
+        if code != 0:
+            log.warning("Couldn't transcode {} to Opus".format(name))
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            return None
+        try:
+            os.replace(tmp, path)
+        except OSError:  # In use on Windows, maybe next time
+            os.remove(tmp)
+            return None
+        if measure:
+            code, opus_cpu = self._run(self._decode_args(path))
+        return source_cpu, opus_cpu
+
+    def _decode_args(self, path):
+        # What the voice client's player does on every playback
+        return [self.player, "-i", path, "-f", "s16le", "-ar", "48000",
+                "-ac", "2", "-loglevel", "quiet", "pipe:1"]
+
+    def _run(self, args):
+        """Returns the exit code and the CPU seconds used, if available
+
+        The process is reaped with wait4 so that only its own usage is
+        counted, not the one of other children ending meanwhile."""
+        try:
+            p = subprocess.Popen(args, stdin=subprocess.DEVNULL,
+                                 stdout=subprocess.DEVNULL,
+                                 stderr=subprocess.DEVNULL)
+        except OSError:
+            return -1, None
+        if resource is None or not hasattr(os, "wait4"):
+            return p.wait(), None
+        _, status, usage = os.wait4(p.pid, 0)
+        if os.WIFSIGNALED(status):
+            p.returncode = -os.WTERMSIG(status)
+        else:
+            p.returncode = os.WEXITSTATUS(status)
+        return p.returncode, usage.ru_utime + usage.ru_stime
+
+
+class DownloadService:
+    """Runs Downloaders on a bounded thread pool
+
+    Every method returns an awaitable resolving to a Downloader, check
+    its error attribute. Concurrent lookups of the same URL and
+    concurrent downloads of the same song id share a single job."""
+
+    def __init__(self, loop, max_workers=4, metadata=None, on_download=None):
+        self.loop = loop
+        self.metadata = metadata
+        self.on_download = on_download
+        self.max_workers = max_workers
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._infos = {}  # url: future
+        self._downloads = {}  # song id: future
+        self.timings = {"metadata": collections.deque(maxlen=100),
+                        "download": collections.deque(maxlen=100)}
+
+    def get_info(self, url, max_duration=None):
+        fut = self._infos.get(url)
+        if fut is None:
+            song = None
+            if self.metadata is not None:
+                song = self.metadata.get_song(url)
+            d = Downloader(url, max_duration)
+            if song is not None:
+                d.song = song
+                fut = self.loop.create_future()
+                fut.set_result(d)
+                return fut
+            fut = self._submit(self._infos, url, d, "metadata")
+            fut.add_done_callback(lambda f: self._remember(url, f))
+        return asyncio.shield(fut)
+
+    def download(self, info_dl):
+        """Downloads the song of a Downloader that already has its info"""
+        song_id = info_dl.song.id
+        fut = self._downloads.get(song_id)
+        if fut is None:
+            d = Downloader(info_dl.url, info_dl.max_duration, download=True,
+                           cache_path=info_dl.cache_path)
+            d.song = info_dl.song
+            fut = self._submit(self._downloads, song_id, d, "download")
+            fut.add_done_callback(self._downloaded)
+        return asyncio.shield(fut)
+
+    def is_busy(self, d):
+        if d.url in self._infos:
+            return True
+        return d.song is not None and d.song.id in self._downloads
+
+    def set_max_workers(self, max_workers):
+        old = self.executor
+        self.max_workers = max_workers
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        old.shutdown(wait=False)  # Running jobs are allowed to finish
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+    def _submit(self, pending, key, d, phase):
+        fut = self.loop.run_in_executor(self.executor, self._run, d, phase)
+        pending[key] = fut
+
+        def done(f):
+            if pending.get(key) is f:
+                del pending[key]
+        fut.add_done_callback(done)
+        return fut
+
+    def _downloaded(self, fut):
+        if self.on_download is None or fut.cancelled() or fut.exception():
+            return
+        d = fut.result()
+        if d.error is None and d.song is not None:
+            self.on_download(d.song.id)
+
+    def _remember(self, url, fut):
+        if self.metadata is None or fut.cancelled() or fut.exception():
+            return
+        d = fut.result()
+        if d.error is None and d.song is not None and d.song.id and \
+                not hasattr(d.song, "entries"):  # Playlists aren't songs
+            self.metadata.put_song(url, d.song)
+
+    def _run(self, d, phase):
+        start = time.perf_counter()
+        d.run()
+        self.timings[phase].append(time.perf_counter() - start)
+        return d
+
+
+class BatchResolver:
+    """Looks up many URLs through a DownloadService, at most concurrency
+    of them at a time and in order, so the first results can be used
+    while the rest are still being resolved"""
+
+    def __init__(self, service, urls, concurrency=4):
+        self.service = service
+        self.semaphore = asyncio.Semaphore(concurrency, loop=service.loop)
+        self.futures = [asyncio.ensure_future(self._resolve(url),
+                                              loop=service.loop)
+                        for url in urls]
+
+    def __len__(self):
+        return len(self.futures)
+
+    async def page(self, start, stop):
+        """Waits for and returns the Downloaders of urls[start:stop]"""
+        return await asyncio.gather(*self.futures[start:stop])
+
+    def cancel(self):
+        for fut in self.futures:
+            fut.cancel()
+
+    async def _resolve(self, url):
+        with (await self.semaphore):
+            return await self.service.get_info(url)
+
 
 class Audio:
     """Music Streaming."""
@@ -309,10 +760,16 @@ class Audio:
         self.bot = bot
         self.queue = {}  # add deque's, repeat
         self.downloaders = {}  # sid: object
+        self.resolvers = {}  # sid: BatchResolver listing a started playlist
         self.settings = dataIO.load_json("data/audio/settings.json")
         self.server_specific_setting_keys = ["VOLUME", "VOTE_ENABLED",
                                              "VOTE_THRESHOLD", "NOPPL_DISCONNECT"]
         self.cache_path = "data/audio/cache"
+        self.cache_index = CacheIndex(self.cache_path)
+        self.metadata_cache = MetadataCache(METADATA_PATH)
+        self.download_service = DownloadService(
+            bot.loop, self.settings["DOWNLOAD_WORKERS"], self.metadata_cache,
+            on_download=self._on_download)
         self.local_playlist_path = "data/audio/localtracks"
         self._old_game = False
 
@@ -320,12 +777,20 @@ class Audio:
 
         self.connect_timers = {}
 
+        self.queue_events = {}  # sid: asyncio.Event, wakes the player task
+        self.queue_players = {}  # sid: player task
+        self.song_ended = {}  # sid: perf_counter() of the last song's end
+        self.track_gaps = {}  # sid: recent gaps between tracks in seconds
+
         if player == "ffmpeg":
             self.settings["AVCONV"] = False
         elif player == "avconv":
             self.settings["AVCONV"] = True
         self.save_settings()
 
+        self.transcoder = OpusTranscoder(bot.loop, self.cache_index,
+                                         player=player)
+
     async def _add_song_status(self, song):
         if self._old_game is False:
             self._old_game = list(self.bot.servers)[0].me.game
@@ -339,18 +804,21 @@ class Audio:
             self._setup_queue(server)
         queued_song = QueuedSong(url, channel)
         self.queue[server.id][QueueKey.QUEUE].append(queued_song)
+        self._wake_player(server.id)
 
     def _add_to_temp_queue(self, server, url, channel):
         if server.id not in self.queue:
             self._setup_queue(server)
         queued_song = QueuedSong(url, channel)
         self.queue[server.id][QueueKey.TEMP_QUEUE].append(queued_song)
+        self._wake_player(server.id)
 
     def _addleft_to_queue(self, server, url, channel):
         if server.id not in self.queue:
-            self._setup_queue()
+            self._setup_queue(server)
         queued_song = QueuedSong(url, channel)
         self.queue[server.id][QueueKey.QUEUE].appendleft(queued_song)
+        self._wake_player(server.id)
 
     def _cache_desired_files(self):
         filelist = []
@@ -363,6 +831,18 @@ class Audio:
         shuffle(filelist)
         return filelist
 
+    def _on_download(self, song_id):
+        self.cache_index.add(song_id)
+
+    def _transcode_next(self, fut):
+        """Transcodes the prefetched next song once it's downloaded"""
+        if fut.cancelled() or fut.exception() is not None:
+            return
+        d = fut.result()
+        if d.error is None and d.song is not None and \
+                d.song.id in self.cache_index.files:
+            self.transcoder.submit(d.song.id)
+
     def _cache_max(self):
         setting_max = self.settings["MAX_CACHE"]
         return max([setting_max, self._cache_min()])  # enforcing hard limit
@@ -372,10 +852,9 @@ class Audio:
         return max([60, 48 * math.log(x) * x**0.3])  # log is not log10
 
     def _cache_required_files(self):
-        queue = copy.deepcopy(self.queue)
         filelist = []
-        for server in queue:
-            now_playing = queue[server].get(QueueKey.NOW_PLAYING)
+        for server_queue in list(self.queue.values()):
+            now_playing = server_queue.get(QueueKey.NOW_PLAYING)
             try:
                 filelist.append(now_playing.id)
             except AttributeError:
@@ -383,10 +862,7 @@ class Audio:
         return filelist
 
     def _cache_size(self):
-        songs = os.listdir(self.cache_path)
-        size = sum(map(lambda s: os.path.getsize(
-            os.path.join(self.cache_path, s)) / 10**6, songs))
-        return size
+        return self.cache_index.size / 10**6
 
     def _cache_too_large(self):
         if self._cache_size() > self._cache_max():
@@ -431,7 +907,10 @@ class Audio:
             song_filename = os.path.join(self.cache_path, filename)
 
         use_avconv = self.settings["AVCONV"]
-        options = '-b:a 64k -bufsize 64k'
+        if not local and self.cache_index.is_opus(filename):
+            options = ''  # Already 48kHz stereo, only needs decoding
+        else:
+            options = '-b:a 64k -bufsize 64k'
         before_options = ''
 
         if start_time:
@@ -449,8 +928,13 @@ class Audio:
 
         log.debug("making player on sid {}".format(server.id))
 
-        voice_client.audio_player = voice_client.create_ffmpeg_player(
-            song_filename, use_avconv=use_avconv, options=options, before_options=before_options)
+        def after():  # Called from the player's thread
+            self.bot.loop.call_soon_threadsafe(self._song_finished, server.id)
+
+        # Music goes through the shared mixer so TTS can talk over it
+        voice_client.audio_player = mixer.create_ffmpeg_source(
+            voice_client, song_filename, use_avconv=use_avconv,
+            options=options, before_options=before_options, after=after)
 
         # Set initial volume
         vol = self.get_server_settings(server)['VOLUME'] / 100
@@ -480,49 +964,32 @@ class Audio:
 
         voice_client = self.voice_client(server)
 
+        mixer.close_mixer(voice_client)
         await voice_client.disconnect()
 
-    async def _download_all(self, queued_song_list, channel):
-        """
-        Doesn't actually download, just get's info for uses like queue_list
-        """
-        downloaders = []
-        for queued_song in queued_song_list:
-            d = Downloader(queued_song.url)
-            d.start()
-            downloaders.append(d)
-
-        while any([d.is_alive() for d in downloaders]):
-            await asyncio.sleep(0.1)
-            
-        songs = [d.song for d in downloaders if d.song is not None and d.error is None]
-           
-        invalid_downloads = [d for d in downloaders if d.error is not None]
-        invalid_number = len(invalid_downloads)
-        if(invalid_number > 0):
-            await self.bot.send_message(channel, "The queue contains {} item(s)"
-                                            " that can not be played.".format(invalid_number))
+    def _resolve_all(self, urls):
+        """Resolves the info of urls in the background, a few at a time
 
-        return songs
+        Doesn't download anything. Returns a BatchResolver"""
+        return BatchResolver(self.download_service, urls,
+                             self.settings["DOWNLOAD_WORKERS"])
 
     async def _download_next(self, server, curr_dl, next_dl):
         """Checks to see if we need to download the next, and does.
 
-        Both curr_dl and next_dl should already be started."""
+        next_dl should already have its info."""
         if curr_dl.song is None:
-            # Only happens when the downloader thread hasn't initialized fully
+            # Only happens when the current lookup hasn't finished yet
             #   There's no reason to wait if we can't compare
             return
 
-        max_length = self.settings["MAX_LENGTH"]
-
-        while next_dl.is_alive():
-            await asyncio.sleep(0.5)
-            
         error = next_dl.error
         if(error is not None):
             raise YouTubeDlError(error)
 
+        if next_dl.song is None:
+            return
+
         if curr_dl.song.id != next_dl.song.id:
             log.debug("downloader ID's mismatch on sid {}".format(server.id) +
                       " gonna start dl-ing the next thing on the queue"
@@ -531,38 +998,37 @@ class Audio:
                 next_dl.duration_check()
             except MaximumLength:
                 return
-            self.downloaders[server.id] = Downloader(next_dl.url, max_length,
-                                                     download=True)
-            self.downloaders[server.id].start()
+            self.downloaders[server.id] = next_dl
+            # Not awaited, _guarantee_downloaded will join it when needed
+            fut = self.download_service.download(next_dl)
+            if self.settings["OPUS_CACHE"]:
+                fut.add_done_callback(self._transcode_next)
+
+    def _dump_cache(self, target=None):
+        """Evicts the least recently played files until the cache is at
+        most target MB (the max cache size by default)
+
+        Files prefetched for queued songs are only evicted if the cache
+        would stay above the max cache size otherwise"""
+        cache_max = self._cache_max() * 10**6
+        if target is None:
+            target = cache_max
+        else:
+            target *= 10**6
 
-    def _dump_cache(self, ignore_desired=False):
         reqd = self._cache_required_files()
         log.debug("required cache files:\n\t{}".format(reqd))
 
         opt = self._cache_desired_files()
         log.debug("desired cache files:\n\t{}".format(opt))
 
-        prev_size = self._cache_size()
+        dumped = self.cache_index.evict(target, keep=reqd + opt)
 
-        for file in os.listdir(self.cache_path):
-            if file not in reqd:
-                if ignore_desired or file not in opt:
-                    try:
-                        os.remove(os.path.join(self.cache_path, file))
-                    except OSError:
-                        # A directory got in the cache?
-                        pass
-                    except WindowsError:
-                        # Removing a file in use, reqd failed
-                        pass
-
-        post_size = self._cache_size()
-        dumped = prev_size - post_size
-
-        if not ignore_desired and self._cache_too_large():
+        if self.cache_index.size > cache_max:
             log.debug("must dump desired files")
-            return dumped + self._dump_cache(ignore_desired=True)
+            dumped += self.cache_index.evict(cache_max, keep=reqd)
 
+        dumped /= 10**6
         log.debug("dumped {} MB of audio files".format(dumped))
 
         return dumped
@@ -630,51 +1096,31 @@ class Audio:
 
     async def _guarantee_downloaded(self, server, url):
         max_length = self.settings["MAX_LENGTH"]
-        if server.id not in self.downloaders:  # We don't have a downloader
-            log.debug("sid {} not in downloaders, making one".format(
-                server.id))
-            self.downloaders[server.id] = Downloader(url, max_length)
 
-        if self.downloaders[server.id].url != url:  # Our downloader is old
-            # I'm praying to Jeezus that we don't accidentally lose a running
-            #   Downloader
-            log.debug("sid {} in downloaders but wrong url".format(server.id))
-            self.downloaders[server.id] = Downloader(url, max_length)
+        # Getting info w/o download. Joins the queue manager's lookup if
+        #   it already started one for this url
+        d = await self.download_service.get_info(url, max_length)
+        self.downloaders[server.id] = d
 
-        try:
-            # We're assuming we have the right thing in our downloader object
-            self.downloaders[server.id].start()
-            log.debug("starting our downloader for sid {}".format(server.id))
-        except RuntimeError:
-            # Queue manager already started it for us, isn't that nice?
-            pass
-
-        # Getting info w/o download
-        self.downloaders[server.id].done.wait()
-        
         # Youtube-DL threw an exception.
-        error = self.downloaders[server.id].error
-        if(error is not None):
-            raise YouTubeDlError(error)
+        if(d.error is not None):
+            raise YouTubeDlError(d.error)
 
         # This will throw a maxlength exception if required
-        self.downloaders[server.id].duration_check()
-        song = self.downloaders[server.id].song
+        d.duration_check()
+        song = d.song
 
         log.debug("sid {} wants to play songid {}".format(server.id, song.id))
 
         # Now we check to see if we have a cache hit
-        cache_location = os.path.join(self.cache_path, song.id)
-        if not os.path.exists(cache_location):
+        if not self.cache_index.lookup(song.id):
             log.debug("cache miss on song id {}".format(song.id))
-            self.downloaders[server.id] = Downloader(url, max_length,
-                                                     download=True)
-            self.downloaders[server.id].start()
+            d = await self.download_service.download(d)
+            self.downloaders[server.id] = d
+            if(d.error is not None):
+                raise YouTubeDlError(d.error)
 
-            while self.downloaders[server.id].is_alive():
-                await asyncio.sleep(0.5)
-
-            song = self.downloaders[server.id].song
+            song = d.song
         else:
             log.debug("cache hit on song id {}".format(song.id))
 
@@ -812,12 +1258,12 @@ class Audio:
                               " YouTube playlist.")
 
     async def _parse_sc_playlist(self, url):
-        playlist = []
-        d = Downloader(url)
-        d.start()
+        playlist = self.metadata_cache.get_playlist(url)
+        if playlist is not None:
+            return playlist
 
-        while d.is_alive():
-            await asyncio.sleep(0.5)
+        playlist = []
+        d = await self.download_service.get_info(url)
 
         error = d.error
         if(error is not None):
@@ -830,15 +1276,16 @@ class Audio:
             else:
                 playlist.append(entry.url)
 
+        self.metadata_cache.put_playlist(url, playlist)
         return playlist
 
     async def _parse_yt_playlist(self, url):
-        d = Downloader(url)
-        d.start()
-        playlist = []
+        playlist = self.metadata_cache.get_playlist(url)
+        if playlist is not None:
+            return playlist
 
-        while d.is_alive():
-            await asyncio.sleep(0.5)
+        d = await self.download_service.get_info(url)
+        playlist = []
 
         error = d.error
         if(error is not None):
@@ -856,6 +1303,7 @@ class Audio:
 
         log.debug("song list:\n\t{}".format(playlist))
 
+        self.metadata_cache.put_playlist(url, playlist)
         return playlist
 
     async def _play(self, sid, url, channel):
@@ -901,6 +1349,12 @@ class Audio:
         voice_client.audio_player.start()
         log.debug("starting player on sid {}".format(server.id))
 
+        ended = self.song_ended.pop(server.id, None)
+        if ended is not None:
+            gaps = self.track_gaps.setdefault(server.id,
+                                              collections.deque(maxlen=50))
+            gaps.append(time.perf_counter() - ended)
+
         return song
 
     def _play_playlist(self, server, playlist, channel):
@@ -926,6 +1380,10 @@ class Audio:
         self._set_queue_repeat(server, True)
         self._set_queue(server, songlist)
 
+        # The previous playlist's listing is out of date
+        if server.id in self.resolvers:
+            self.resolvers.pop(server.id).cancel()
+
     def _play_local_playlist(self, server, name, channel):
         songlist = self._local_playlist_songlist(name)
 
@@ -946,8 +1404,7 @@ class Audio:
 
     def _player_count(self):
         count = 0
-        queue = copy.deepcopy(self.queue)
-        for sid in queue:
+        for sid in list(self.queue):
             server = self.bot.get_server(sid)
             try:
                 vc = self.voice_client(server)
@@ -1009,6 +1466,12 @@ class Audio:
                                                              playlist))
         dataIO.save_json(f, playlist)
 
+    def _song_finished(self, sid):
+        server = self.bot.get_server(sid)
+        if server is not None and not self.is_playing(server):
+            self.song_ended[sid] = time.perf_counter()
+        self._wake_player(sid)
+
     def _shuffle_queue(self, server):
         shuffle(self.queue[server.id][QueueKey.QUEUE])
 
@@ -1024,6 +1487,7 @@ class Audio:
         else:
             self._setup_queue(server)
         self.queue[server.id][QueueKey.QUEUE].extend(songlist)
+        self._wake_player(server.id)
 
     def _set_queue_channel(self, server, channel):
         if server.id not in self.queue:
@@ -1147,6 +1611,34 @@ class Audio:
         await self.bot.say("Max cache size set to {} MB.".format(size))
         self.save_settings()
 
+    @audioset.command(name="downloaders")
+    @checks.is_owner()
+    async def audioset_downloaders(self, workers: int):
+        """Maximum number of concurrent youtube-dl jobs"""
+        if workers < 1:
+            await self.bot.say("There must be at least one worker.")
+            return
+        self.settings["DOWNLOAD_WORKERS"] = workers
+        self.download_service.set_max_workers(workers)
+        await self.bot.say("Up to {} songs will now be looked up or"
+                           " downloaded at the same time.".format(workers))
+        self.save_settings()
+
+    @audioset.command(name="opuscache")
+    @checks.is_owner()
+    async def audioset_opuscache(self):
+        """Toggles transcoding the next queued song to Opus, ahead of time"""
+        self.settings["OPUS_CACHE"] = not self.settings["OPUS_CACHE"]
+        if self.settings["OPUS_CACHE"]:
+            await self.bot.say("The next song in the queue will now be"
+                               " transcoded to Opus in the background."
+                               " Songs already in the cache are left as"
+                               " they are.")
+        else:
+            await self.bot.say("Downloaded songs will no longer be"
+                               " transcoded.")
+        self.save_settings()
+
     @audioset.command(name="emptydisconnect", pass_context=True)
     @checks.mod_or_permissions(manage_messages=True)
     async def audioset_emptydisconnect(self, ctx):
@@ -1269,6 +1761,66 @@ class Audio:
         await self.bot.say("Currently playing music in {} servers.".format(
             count))
 
+    @audiostat.command(name="downloads")
+    async def audiostat_downloads(self):
+        """Timings of youtube-dl lookups and downloads."""
+        service = self.download_service
+        msg = "Workers: {}\n".format(service.max_workers)
+        for phase, timings in service.timings.items():
+            if timings:
+                avg = 1000 * sum(timings) / len(timings)
+                msg += "{}: {:.0f} ms average over the last {}\n".format(
+                    phase.capitalize(), avg, len(timings))
+            else:
+                msg += "{}: nothing recorded\n".format(phase.capitalize())
+        await self.bot.say(msg)
+
+    @audiostat.command(name="metadata")
+    async def audiostat_metadata(self):
+        """Hit rate of the song / playlist lookup cache."""
+        cache = self.metadata_cache
+        lookups = cache.hits + cache.misses
+        rate = 100 * cache.hits / lookups if lookups else 0
+        await self.bot.say("Metadata cache:\n"
+                           "Songs: {}\n"
+                           "Playlists: {}\n"
+                           "Hits: {}\n"
+                           "Misses: {}\n"
+                           "Hit rate: {:.1f}%".format(
+                               len(cache.songs), len(cache.playlists),
+                               cache.hits, cache.misses, rate))
+
+    @audiostat.command(name="transcode")
+    async def audiostat_transcode(self):
+        """CPU used per playback with and without the Opus cache."""
+        t = self.transcoder
+        msg = ("Opus cache: {}\n"
+               "Transcoded: {} ({} failed, {} pending)\n".format(
+                   "on" if self.settings["OPUS_CACHE"] else "off",
+                   t.transcoded, t.failed, len(t._pending)))
+        if t.measured:
+            source = 1000 * t.source_cpu / t.measured
+            opus = 1000 * t.opus_cpu / t.measured
+            msg += ("Decoding CPU per playback, over {} tracks:\n"
+                    "Original: {:.0f} ms\n"
+                    "Opus: {:.0f} ms".format(t.measured, source, opus))
+        else:
+            msg += "No CPU measurements yet."
+        await self.bot.say(msg)
+
+    @audiostat.command(name="gaps", pass_context=True, no_pm=True)
+    async def audiostat_gaps(self, ctx):
+        """Silence between the last tracks played in this server."""
+        gaps = self.track_gaps.get(ctx.message.server.id)
+        if not gaps:
+            await self.bot.say("No track changes recorded on this server.")
+            return
+        await self.bot.say("Gap between tracks over the last {} changes:\n"
+                           "Average: {:.0f} ms\n"
+                           "Worst: {:.0f} ms".format(
+                               len(gaps), 1000 * sum(gaps) / len(gaps),
+                               1000 * max(gaps)))
+
     @commands.group(pass_context=True)
     async def cache(self, ctx):
         """Cache management tools."""
@@ -1280,7 +1832,8 @@ class Audio:
     @checks.is_owner()
     async def cache_dump(self):
         """Dumps the cache."""
-        dumped = self._dump_cache()
+        self.cache_index.rescan()
+        dumped = self._dump_cache(target=0)
         await self.bot.say("Dumped {:.3f} MB of audio files.".format(dumped))
 
     @cache.command(name='stats')
@@ -1289,13 +1842,21 @@ class Audio:
             - Current size of the cache.
             - Maximum cache size. User setting or minimum, whichever is higher.
             - Minimum cache size. Automatically determined by number of servers Red is running on.
+            - Hit rate of played songs and total size evicted.
         """
+        index = self.cache_index
+        lookups = index.hits + index.misses
+        hit_rate = 100 * index.hits / lookups if lookups else 0
         await self.bot.say("Cache stats:\n"
-                           "Current size: {:.2f} MB\n"
+                           "Current size: {:.2f} MB ({} files)\n"
                            "Maximum: {:.1f} MB\n"
-                           "Minimum: {:.1f} MB".format(self._cache_size(),
-                                                       self._cache_max(),
-                                                       self._cache_min()))
+                           "Minimum: {:.1f} MB\n"
+                           "Hit rate: {:.1f}% ({}/{})\n"
+                           "Evicted: {:.2f} MB".format(
+                               self._cache_size(), len(index.files),
+                               self._cache_max(), self._cache_min(),
+                               hit_rate, index.hits, lookups,
+                               index.evicted / 10**6))
 
     @commands.group(pass_context=True, hidden=True, no_pm=True)
     @checks.is_owner()
@@ -1713,7 +2274,7 @@ class Audio:
                 shuffle(playlist.playlist)
 
             self._play_playlist(server, playlist, channel)
-            await self.bot.say("Playlist queued.")
+            await self._list_playlist(server, channel)
         else:
             await self.bot.say("That playlist does not exist.")
 
@@ -1791,31 +2352,67 @@ class Audio:
         if now_playing is not None:
             msg += "\n***Now playing:***\n{}\n".format(now_playing.title)
 
-        queued_song_list = self._get_queue(server, 5)
-        tempqueued_song_list = self._get_queue_tempqueue(server, 5)
+        queued_song_list = self._get_queue_tempqueue(server,
+                                                     QUEUE_LIST_LENGTH)
+        queued_song_list += self._get_queue(
+            server, QUEUE_LIST_LENGTH - len(queued_song_list))
 
-        await self.bot.say("Gathering information...")
+        resolver = self._resolve_all([q.url for q in queued_song_list])
+        invalid_number = await self._send_song_list(
+            channel, msg + "\n***Next up:***\n", resolver)
 
-        queue_song_list = await self._download_all(queued_song_list, channel)
-        tempqueue_song_list = await self._download_all(tempqueued_song_list, channel)
-
-        song_info = []
-        for num, song in enumerate(tempqueue_song_list, 1):
-            try:
-                song_info.append("{}. {.title}".format(num, song))
-            except AttributeError:
-                song_info.append("{}. {.webpage_url}".format(num, song))
+        if invalid_number > 0:
+            await self.bot.send_message(channel, "The queue contains {} item(s)"
+                                        " that can not be played.".format(
+                                            invalid_number))
 
-        for num, song in enumerate(queue_song_list, len(song_info) + 1):
-            if num > 5:
-                break
-            try:
-                song_info.append("{}. {.title}".format(num, song))
-            except AttributeError:
-                song_info.append("{}. {.webpage_url}".format(num, song))
-        msg += "\n***Next up:***\n" + "\n".join(song_info)
+    async def _send_song_list(self, channel, header, resolver):
+        """Sends header followed by the titles resolver looks up, and
+        returns how many couldn't be
 
-        await self.bot.say(msg)
+        The first page is sent as soon as it's resolved, the message is
+        then edited as the next ones come in"""
+        song_info = []
+        invalid_number = 0
+        reply = None
+        for start in range(0, len(resolver), QUEUE_LIST_PAGE):
+            downloaders = await resolver.page(start, start + QUEUE_LIST_PAGE)
+            for d in downloaders:
+                if d.error is not None or d.song is None:
+                    invalid_number += 1
+                    continue
+                num = len(song_info) + 1
+                if d.song.title:
+                    song_info.append("{}. {.title}".format(num, d.song))
+                else:
+                    song_info.append("{}. {.webpage_url}".format(num, d.song))
+            page = header + "\n".join(song_info)
+            if start + QUEUE_LIST_PAGE < len(resolver):
+                page += "\n*Gathering information...*"
+            if reply is None:
+                reply = await self.bot.send_message(channel, page)
+            else:
+                reply = await self.bot.edit_message(reply, page)
+        return invalid_number
+
+    async def _list_playlist(self, server, channel):
+        """Answers playlist start with the first QUEUE_LIST_LENGTH songs,
+        only looking those up"""
+        urls = [q.url for q in self._get_queue(server, QUEUE_LIST_LENGTH)
+                if self._valid_playable_url(q.url)]
+        if not urls:
+            await self.bot.send_message(channel, "Playlist queued.")
+            return
+        resolver = self._resolve_all(urls)
+        self.resolvers[server.id] = resolver
+        try:
+            await self._send_song_list(
+                channel, "Playlist queued.\n\n***Next up:***\n", resolver)
+        except asyncio.CancelledError:  # Another playlist was started
+            pass
+        finally:
+            if self.resolvers.get(server.id) is resolver:
+                del self.resolvers[server.id]
 
     @commands.group(pass_context=True, no_pm=True)
     async def repeat(self, ctx):
@@ -2029,6 +2626,8 @@ class Audio:
 
     async def cache_manager(self):
         while self == self.bot.get_cog("Audio"):
+            if self.metadata_cache.dirty:
+                self.metadata_cache.save()
             if self._cache_too_large():
                 # Our cache is too big, dumping
                 log.debug("cache too large ({} > {}), dumping".format(
@@ -2043,7 +2642,7 @@ class Audio:
 
     def currently_downloading(self, server):
         if server.id in self.downloaders:
-            if self.downloaders[server.id].is_alive():
+            if self.download_service.is_busy(self.downloaders[server.id]):
                 return True
         return False
 
@@ -2191,19 +2790,18 @@ class Audio:
                 queued_next_song = temp_queue.peekleft()
                 next_url = queued_next_song.url
                 next_channel = queued_next_song.channel
-                next_dl = Downloader(next_url, max_length)
             elif len(queue) > 0:
                 queued_next_song = queue.peekleft()
                 next_url = queued_next_song.url
                 next_channel = queued_next_song.channel	
-                next_dl = Downloader(next_url, max_length)
             else:
-                next_dl = None
+                next_url = None
 
-            if next_dl is not None:
+            if next_url is not None:
                 try:
                     # Download next song
-                    next_dl.start()
+                    next_dl = await self.download_service.get_info(
+                        next_url, max_length)
                     await self._download_next(server, curr_dl, next_dl)
                 except YouTubeDlError as e:
                     if len(temp_queue) > 0:
@@ -2216,23 +2814,47 @@ class Audio:
                     message = escape(message, mass_mentions=True)
                     await self.bot.send_message(next_channel, message)
 
-    async def queue_scheduler(self):
+    async def queue_player(self, sid):
+        """One per server. Sleeps until something is enqueued, skipped or
+            a song finishes, then lets queue_manager act on it"""
+        event = self.queue_events[sid]
         while self == self.bot.get_cog('Audio'):
-            tasks = []
-            queue = copy.deepcopy(self.queue)
-            for sid in queue:
-                if len(queue[sid][QueueKey.QUEUE]) == 0 and \
-                        len(queue[sid][QueueKey.TEMP_QUEUE]) == 0:
-                    continue
-                # log.debug("scheduler found a non-empty queue"
-                #           " for sid: {}".format(sid))
-                tasks.append(
-                    self.bot.loop.create_task(self.queue_manager(sid)))
-            completed = [t.done() for t in tasks]
-            while not all(completed):
-                completed = [t.done() for t in tasks]
-                await asyncio.sleep(0.5)
-            await asyncio.sleep(1)
+            await event.wait()
+            event.clear()
+            if not self._queue_pending(sid):
+                continue
+            server = self.bot.get_server(sid)
+            if server is None:
+                continue
+            try:
+                was_playing = self.is_playing(server)
+                await self.queue_manager(sid)
+                if not was_playing and self.is_playing(server):
+                    # A song just started, get the next one ready
+                    await self.queue_manager(sid)
+            except Exception as e:
+                log.exception("queue manager failed on sid {}".format(sid),
+                              exc_info=e)
+            if not self.is_playing(server) and self._queue_pending(sid):
+                # Nothing was started (too long, unavailable or an error),
+                # the rest of the queue still needs to be played
+                await asyncio.sleep(QUEUE_RETRY_DELAY)
+                event.set()
+
+    def _queue_pending(self, sid):
+        if sid not in self.queue:
+            return False
+        return len(self.queue[sid][QueueKey.QUEUE]) > 0 or \
+            len(self.queue[sid][QueueKey.TEMP_QUEUE]) > 0
+
+    def _wake_player(self, sid):
+        if sid not in self.queue_events:
+            self.queue_events[sid] = asyncio.Event(loop=self.bot.loop)
+        task = self.queue_players.get(sid)
+        if task is None or task.done():
+            self.queue_players[sid] = self.bot.loop.create_task(
+                self.queue_player(sid))
+        self.queue_events[sid].set()
 
     async def reload_monitor(self):
         while self == self.bot.get_cog('Audio'):
@@ -2293,7 +2915,15 @@ class Audio:
                 vc.audio_player.resume()
 
     def __unload(self):
+        for task in self.queue_players.values():
+            task.cancel()
+        for resolver in self.resolvers.values():
+            resolver.cancel()
+        self.download_service.shutdown()
+        self.transcoder.shutdown()
+        self.metadata_cache.save()
         for vc in self.bot.voice_clients:
+            mixer.close_mixer(vc)
             self.bot.loop.create_task(vc.disconnect())
 
 
@@ -2310,7 +2940,7 @@ def check_files():
     default = {"VOLUME": 50, "MAX_LENGTH": 3700, "VOTE_ENABLED": True,
                "MAX_CACHE": 0, "SOUNDCLOUD_CLIENT_ID": None,
                "TITLE_STATUS": True, "AVCONV": False, "VOTE_THRESHOLD": 50,
-               "SERVERS": {}}
+               "DOWNLOAD_WORKERS": 4, "OPUS_CACHE": False, "SERVERS": {}}
     settings_path = "data/audio/settings.json"
 
     if not os.path.isfile(settings_path):
@@ -2333,6 +2963,11 @@ def check_files():
             dataIO.save_json(settings_path, current)
 
 
+    if not os.path.isfile(METADATA_PATH):
+        print("Creating empty audio metadata.json...")
+        dataIO.save_json(METADATA_PATH, {})
+
+
 def verify_ffmpeg_avconv():
     try:
         subprocess.call(["ffmpeg", "-version"], stdout=subprocess.DEVNULL)
@@ -2380,7 +3015,6 @@ def setup(bot):
     n = Audio(bot, player=player)  # Praise 26
     bot.add_cog(n)
     bot.add_listener(n.voice_state_update, 'on_voice_state_update')
-    bot.loop.create_task(n.queue_scheduler())
     bot.loop.create_task(n.disconnect_timer())
     bot.loop.create_task(n.reload_monitor())
     bot.loop.create_task(n.cache_scheduler())
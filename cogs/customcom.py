@@ -15,6 +15,13 @@ class CustomCommands:
         self.bot = bot
         self.file_path = "data/customcom/commands.json"
         self.c_commands = dataIO.load_json(self.file_path)
+        self.bot.dispatch_table.register("customcoms", self.server_commands)
+
+    def __unload(self):
+        self.bot.dispatch_table.unregister("customcoms")
+
+    def server_commands(self, sid):
+        return self.c_commands.get(sid, {})
 
     @commands.group(aliases=["cc"], pass_context=True, no_pm=True)
     async def customcom(self, ctx):
@@ -45,6 +52,7 @@ class CustomCommands:
             cmdlist[command] = text
             self.c_commands[server.id] = cmdlist
             dataIO.save_json(self.file_path, self.c_commands)
+            self.bot.dispatch_table.invalidate(server.id)
             await self.bot.say("Custom command successfully added.")
         else:
             await self.bot.say("This command already exists. Use "
@@ -67,6 +75,7 @@ class CustomCommands:
                 cmdlist[command] = text
                 self.c_commands[server.id] = cmdlist
                 dataIO.save_json(self.file_path, self.c_commands)
+                self.bot.dispatch_table.invalidate(server.id)
                 await self.bot.say("Custom command successfully edited.")
             else:
                 await self.bot.say("That command doesn't exist. Use "
@@ -92,6 +101,7 @@ class CustomCommands:
                 cmdlist.pop(command, None)
                 self.c_commands[server.id] = cmdlist
                 dataIO.save_json(self.file_path, self.c_commands)
+                self.bot.dispatch_table.invalidate(server.id)
                 await self.bot.say("Custom command successfully deleted.")
             else:
                 await self.bot.say("That command doesn't exist.")
@@ -125,29 +135,14 @@ class CustomCommands:
         if len(message.content) < 2 or message.channel.is_private:
             return
 
-        server = message.server
-        prefix = self.get_prefix(message)
+        dispatch = self.bot.dispatch_table.classify(message)
 
-        if not prefix:
+        if dispatch is None or not dispatch.prefix:
             return
 
-        if server.id in self.c_commands and self.bot.user_allowed(message):
-            cmdlist = self.c_commands[server.id]
-            cmd = message.content[len(prefix):]
-            if cmd in cmdlist:
-                cmd = cmdlist[cmd]
-                cmd = self.format_cc(cmd, message)
-                await self.bot.send_message(message.channel, cmd)
-            elif cmd.lower() in cmdlist:
-                cmd = cmdlist[cmd.lower()]
-                cmd = self.format_cc(cmd, message)
-                await self.bot.send_message(message.channel, cmd)
-
-    def get_prefix(self, message):
-        for p in self.bot.settings.get_prefixes(message.server):
-            if message.content.startswith(p):
-                return p
-        return False
+        if dispatch.customcom is not None and self.bot.user_allowed(message):
+            cmd = self.format_cc(dispatch.customcom, message)
+            await self.bot.send_message(message.channel, cmd)
 
     def format_cc(self, command, message):
         results = re.findall("\{([^}]+)\}", command)
@@ -6,17 +6,223 @@ from .utils.chat_formatting import box
 from collections import Counter, defaultdict, namedtuple
 import discord
 import asyncio
+import logging
+import queue
+import re
 import sqlite3 as lite
 import sys
 import os
+import threading
+import time
+
+try:
+    from wordcloud import STOPWORDS
+except ImportError:
+    STOPWORDS = set()
+
+log = logging.getLogger("red.database")
 
 DATABASE_PATH = "data/database/data.db"
+BATCH_SIZE = 500  # messages per transaction at most
+BATCH_INTERVAL = 0.5  # seconds a message can wait for its batch
+RETRY_MAX_DELAY = 60  # seconds between attempts at a batch that failed
+BACKFILL_CHANNELS = 3  # channels fetched at the same time
+BACKFILL_LIMIT = 99999  # messages per channel per run
+BACKFILL_MAX_PENDING = 5000  # fetching waits while the archiver catches up
+BACKFILL_CURSOR_EVERY = 100  # messages between saved positions
+BACKFILL_REPORT_INTERVAL = 5  # seconds
+WORD_PATTERN = re.compile(r"\w[\w']*")
+IGNORED_WORDS = STOPWORDS | {"wordcloud", "mycloud", "servercloud",
+                             "channelcloud"}
+
+
+class MessageArchiver:
+    """Writes messages to the database from a dedicated thread
+
+    Messages are queued as plain rows and written in one transaction every
+    BATCH_SIZE messages or BATCH_INTERVAL seconds, whichever comes first.
+    Rows already in the database are skipped by their primary keys. A
+    batch that can't be written is kept and retried with the next one,
+    waiting longer after each failure.
+
+    Backfill positions go through the same queue, so a saved position is
+    never ahead of the messages actually written.
+
+    Words and counts of messages archived before WORDS and MESSAGE_COUNT
+    existed are counted here too, BATCH_SIZE messages at a time between
+    the queued batches, from the position saved in WORDS_BACKFILL."""
+
+    MESSAGE = 0
+    CURSOR = 1
+
+    def __init__(self, path, batch_size=BATCH_SIZE, interval=BATCH_INTERVAL):
+        self.path = path
+        self.batch_size = batch_size
+        self.interval = interval
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, name="archiver",
+                                       daemon=True)
+        self.started = time.time()
+        self.archived = 0  # messages written, including duplicates skipped
+        self.batches = 0
+        self.errors = 0
+        self.write_time = 0.0  # seconds spent in transactions
+        self.words_position = 0  # MESSAGE rowid words are counted up to
+        self.words_target = 0  # and the last one that needs counting
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self, timeout=10):
+        """Writes what's left in the queue and ends the thread"""
+        self.queue.put(None)
+        self.thread.join(timeout)
+
+    def put(self, message):
+        """Queues a message, called from the event loop"""
+        server = message.server
+        if server is None:
+            return
+        author = message.author
+        owner_id = server.owner.id if server.owner is not None else None
+        # name, id, bot, avatar, created_at
+        user_row = (string(author.name), author.id, string(author.bot),
+                    string(author.avatar), string(author.created_at))
+        # name, id, owner_id
+        server_row = (string(server.name), server.id, owner_id)
+        message_row = (message.id, string(message.edited_timestamp),
+                       string(message.timestamp), string(message.tts),
+                       string(author.name), author.id, message.content,
+                       server.id, message.channel.id)
+        self.queue.put((self.MESSAGE, (user_row, server_row, message_row)))
+
+    def put_cursor(self, channel_id, oldest_id, newest_id, done):
+        """Queues a channel's backfill position"""
+        self.queue.put((self.CURSOR, (channel_id, oldest_id, newest_id,
+                                      int(done))))
+
+    def pending(self):
+        return self.queue.qsize()
+
+    def words_counted(self):
+        return self.words_position >= self.words_target
+
+    def _run(self):
+        conn = lite.connect(self.path)
+        # Safe with WAL, only a power loss can drop the last transactions
+        conn.execute("PRAGMA synchronous=NORMAL")
+        self.words_position, self.words_target = conn.execute(
+            "SELECT position, target FROM WORDS_BACKFILL").fetchone()
+        try:
+            batch = []  # kept until it's written
+            failures = 0
+            running = True
+            while running:
+                if not batch:
+                    if self.words_counted():
+                        item = self.queue.get()
+                    else:
+                        # Queued messages go first, one batch each turn
+                        try:
+                            item = self.queue.get_nowait()
+                        except queue.Empty:
+                            self._count_words(conn)
+                            continue
+                    if item is None:
+                        break
+                    batch.append(item)
+                deadline = time.monotonic() + self.interval
+                while len(batch) < self.batch_size:
+                    timeout = deadline - time.monotonic()
+                    if timeout <= 0:
+                        break
+                    try:
+                        item = self.queue.get(timeout=timeout)
+                    except queue.Empty:
+                        break
+                    if item is None:
+                        running = False
+                        break
+                    batch.append(item)
+                if self._write(conn, batch):
+                    batch = []
+                    failures = 0
+                elif running:
+                    failures += 1
+                    time.sleep(min(self.interval * 2 ** failures,
+                                   RETRY_MAX_DELAY))
+            if batch:
+                log.error("Stopped with {} queued items that couldn't be "
+                          "archived".format(len(batch)))
+        finally:
+            conn.close()
+
+    def _write(self, conn, batch):
+        """Returns False if the batch couldn't be written"""
+        messages = [rows for kind, rows in batch if kind == self.MESSAGE]
+        cursors = [row for kind, row in batch if kind == self.CURSOR]
+        start = time.perf_counter()
+        try:
+            with conn:
+                conn.executemany("INSERT OR IGNORE INTO USER VALUES "
+                                 "(?,?,?,?,?)", set(m[0] for m in messages))
+                conn.executemany("INSERT OR IGNORE INTO SERVERS VALUES "
+                                 "(?,?,?)", set(m[1] for m in messages))
+                # Only messages that weren't archived yet count words
+                added = []
+                for m in messages:
+                    c = conn.execute("INSERT OR IGNORE INTO MESSAGE VALUES "
+                                     "(?,?,?,?,?,?,?,?,?)", m[2])
+                    if c.rowcount == 1:
+                        added.append(m[2])
+                add_words(conn, added)
+                add_counts(conn, added)
+                conn.executemany("INSERT OR REPLACE INTO BACKFILL VALUES "
+                                 "(?,?,?,?)", cursors)
+        except lite.Error:
+            self.errors += 1
+            log.exception("Couldn't archive {} messages, retrying".format(
+                len(messages)))
+            return False
+        self.write_time += time.perf_counter() - start
+        self.archived += len(messages)
+        self.batches += 1
+        if not self.words_counted():
+            self._count_words(conn)
+        return True
+
+    def _count_words(self, conn):
+        """Counts the words of the next batch of older messages"""
+        try:
+            with conn:
+                rows = conn.execute("SELECT rowid, * FROM MESSAGE WHERE "
+                                    "rowid > ? AND rowid <= ? ORDER BY rowid "
+                                    "LIMIT ?", (self.words_position,
+                                                self.words_target,
+                                                self.batch_size)).fetchall()
+                add_words(conn, [row[1:] for row in rows])
+                add_counts(conn, [row[1:] for row in rows])
+                position = rows[-1][0] if rows else self.words_target
+                conn.execute("UPDATE WORDS_BACKFILL SET position=?",
+                             (position,))
+        except lite.Error:
+            self.errors += 1
+            log.exception("Couldn't count the words of older messages")
+            time.sleep(self.interval)
+            return
+        self.words_position = position
+
 
 class Database:
     """General commands."""
     def __init__(self, bot):
-        self.database = lite.connect(DATABASE_PATH)
+        self.archiver = MessageArchiver(DATABASE_PATH)
+        self.archiver.start()
         self.client = bot
+        self.backfills = set()  # server ids being backfilled
+
+    def __unload(self):
+        self.archiver.stop()
 
     async def on_message(self, message):
         self.save_message_to_database(message)
@@ -24,46 +230,113 @@ class Database:
     @commands.command(hidden=True, pass_context=True)
     @checks.mod_or_permissions(manage_server=True)
     async def rebuild_database(self, ctx):
+        """Archives the server's message history
+
+        Each channel continues from where the last run stopped, and
+        channels that were finished only fetch what's new since then."""
         server = ctx.message.server
         client = self.client
-        for channel in server.channels:
-            if channel.type == discord.ChannelType.text:
-                print("Saving channel " + channel.name)
-                async for message in client.logs_from(channel, limit=99999):
-                    self.save_message_to_database(message)
-        
-    def save_message_to_database(self, message):
-        server = message.server
-        author = message.author
-        channel = message.channel
-       
-        if server is None:
+        if server.id in self.backfills:
+            await client.say("This server is already being backfilled.")
             return
-       
-        c = self.database.cursor()
-
-        sql_cmd = "SELECT EXISTS(SELECT 1 FROM USER WHERE id=? collate nocase) LIMIT 1"
-        c.execute(sql_cmd, (author.id,))
-        if c.fetchone()[0]==0:
-            # name, id, bot, avatar, created_at
-            sql_cmd = "INSERT INTO USER VALUES (?,?,?,?,?)"
-            c.execute(sql_cmd, (string(author.name), author.id, string(author.bot), string(author.avatar), string(author.created_at),))
-
-        sql_cmd = "SELECT EXISTS(SELECT 1 FROM SERVERS WHERE id=? collate nocase) LIMIT 1"
-        c.execute(sql_cmd, (server.id,))
-        if c.fetchone()[0]==0:
-            # name, id, owner_id
-            sql_cmd = "INSERT INTO USER VALUES (?,?,?)"
-            c.execute(sql_cmd, (string(server.name),server.id,server.owner.id,))
-
-        sql_cmd = "SELECT EXISTS(SELECT 1 FROM MESSAGE WHERE message_id=? collate nocase) LIMIT 1"
-        c.execute(sql_cmd, (message.id,))
-        if c.fetchone()[0]==0:
-            sql_cmd = "INSERT INTO MESSAGE VALUES (?,?,?,?,?,?,?,?,?)"  
-
-            c.execute(sql_cmd, (message.id,string(message.edited_timestamp),string(message.timestamp),string(message.tts),string(message.author.name),message.author.id,message.content,message.server.id,message.channel.id,))
-        self.database.commit()  
-        
+        channels = [c for c in server.channels
+                    if c.type == discord.ChannelType.text]
+        cursors = await client.loop.run_in_executor(
+            None, load_cursors, DATABASE_PATH, [c.id for c in channels])
+
+        self.backfills.add(server.id)
+        progress = {"messages": 0, "remaining": len(channels), "skipped": 0}
+        semaphore = asyncio.Semaphore(BACKFILL_CHANNELS, loop=client.loop)
+        tasks = [client.loop.create_task(self._backfill_channel(
+                     channel, cursors.get(channel.id), semaphore, progress))
+                 for channel in channels]
+        status = await client.say("Backfilling {} channels...".format(
+            len(channels)))
+        start = time.time()
+        try:
+            pending = tasks
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, timeout=BACKFILL_REPORT_INTERVAL,
+                    loop=client.loop)
+                for task in done:
+                    if task.exception() is not None:
+                        log.error("Backfill of a channel failed",
+                                  exc_info=task.exception())
+                elapsed = max(time.time() - start, 1)
+                msg = ("Backfilling: {} messages, {:.0f} messages/s, {} of {}"
+                       " channels remaining".format(
+                           progress["messages"], progress["messages"] / elapsed,
+                           progress["remaining"], len(channels)))
+                if pending:
+                    await client.edit_message(status, msg)
+        finally:
+            self.backfills.discard(server.id)
+            for task in tasks:
+                task.cancel()
+
+        msg = "Backfill done: {} messages in {:.0f} seconds.".format(
+            progress["messages"], time.time() - start)
+        if progress["skipped"]:
+            msg += " {} channels couldn't be read.".format(progress["skipped"])
+        await client.edit_message(status, msg)
+
+    async def _backfill_channel(self, channel, cursor, semaphore, progress):
+        oldest, newest, done = cursor or (None, None, False)
+        with (await semaphore):
+            try:
+                if done and newest is not None:
+                    kwargs = {"after": discord.Object(id=newest)}
+                elif oldest is not None:
+                    kwargs = {"before": discord.Object(id=oldest)}
+                else:
+                    kwargs = {}
+                count = 0
+                async for message in self.client.logs_from(
+                        channel, limit=BACKFILL_LIMIT, **kwargs):
+                    self.archiver.put(message)
+                    if oldest is None or int(message.id) < int(oldest):
+                        oldest = message.id
+                    if newest is None or int(message.id) > int(newest):
+                        newest = message.id
+                    count += 1
+                    progress["messages"] += 1
+                    if count % BACKFILL_CURSOR_EVERY == 0:
+                        self.archiver.put_cursor(channel.id, oldest, newest,
+                                                 done)
+                        while self.archiver.pending() > BACKFILL_MAX_PENDING:
+                            await asyncio.sleep(0.1)
+                # Hitting the limit means there's more for the next run
+                done = done or count < BACKFILL_LIMIT
+                self.archiver.put_cursor(channel.id, oldest, newest, done)
+            except discord.Forbidden:
+                progress["skipped"] += 1
+            finally:
+                progress["remaining"] -= 1
+
+    @commands.command(hidden=True)
+    @checks.is_owner()
+    async def dbstats(self):
+        """Shows the message archiver's throughput"""
+        a = self.archiver
+        uptime = max(time.time() - a.started, 1)
+        msg = ("Archived: {} messages in {} transactions\n"
+               "Waiting: {}\n"
+               "Failed transactions: {}\n"
+               "Throughput: {:.1f} messages/s since load".format(
+                   a.archived, a.batches, a.pending(), a.errors,
+                   a.archived / uptime))
+        if not a.words_counted():
+            msg += "\nCounting words of older messages: {} of {}".format(
+                a.words_position, a.words_target)
+        if a.batches:
+            msg += "\nAverage transaction: {:.1f} messages, {:.1f} ms".format(
+                a.archived / a.batches, 1000 * a.write_time / a.batches)
+        await self.client.say(box(msg))
+
+    def save_message_to_database(self, message):
+        self.archiver.put(message)
+
 def check_folders():
     folders = ("data", "data/database/")
     for folder in folders:
@@ -71,13 +344,127 @@ def check_folders():
             print("Creating " + folder + " folder...")
             os.makedirs(folder)
 
+def load_cursors(path, channel_ids):
+    """Returns {channel_id: (oldest_id, newest_id, done)} from BACKFILL"""
+    conn = lite.connect(path)
+    try:
+        cursors = {}
+        for channel_id in channel_ids:
+            row = conn.execute("SELECT oldest_id, newest_id, done FROM "
+                               "BACKFILL WHERE channel_id=?",
+                               (channel_id,)).fetchone()
+            if row is not None:
+                cursors[channel_id] = (row[0], row[1], bool(row[2]))
+        return cursors
+    finally:
+        conn.close()
+
+def count_words(text):
+    """Lowercased words of text, without stopwords"""
+    return Counter(w for w in WORD_PATTERN.findall(text.lower())
+                   if len(w) > 1 and w not in IGNORED_WORDS)
+
+def add_words(conn, message_rows):
+    """Adds the messages' words to WORDS, inside the caller's transaction"""
+    totals = Counter()
+    for row in message_rows:
+        # server_id, channel_id, author_id
+        key = (row[7], row[8], row[5])
+        for word, count in count_words(row[6] or "").items():
+            totals[key + (word,)] += count
+    rows = [key + (count,) for key, count in totals.items()]
+    conn.executemany("INSERT OR IGNORE INTO WORDS VALUES (?,?,?,?,0)",
+                     (row[:4] for row in rows))
+    conn.executemany("UPDATE WORDS SET count = count + ? WHERE server_id=? "
+                     "AND channel_id=? AND author_id=? AND word=?",
+                     ((row[4],) + row[:4] for row in rows))
+
+def add_counts(conn, message_rows):
+    """Adds the messages to MESSAGE_COUNT, inside the caller's transaction"""
+    totals = Counter((row[7], row[8], row[5]) for row in message_rows)
+    conn.executemany("INSERT OR IGNORE INTO MESSAGE_COUNT VALUES (?,?,?,0)",
+                     totals)
+    conn.executemany("UPDATE MESSAGE_COUNT SET count = count + ? WHERE "
+                     "server_id=? AND channel_id=? AND author_id=?",
+                     ((count,) + key for key, count in totals.items()))
+
+ARCHIVE_TABLES = (
+    ("USER", "name TEXT, id TEXT PRIMARY KEY, bot TEXT, avatar TEXT, "
+             "created_at TEXT"),
+    ("SERVERS", "name TEXT, id TEXT PRIMARY KEY, owner_id TEXT"),
+    ("MESSAGE", "message_id TEXT PRIMARY KEY, edited_timestamp TEXT, "
+                "timestamp TEXT, tts TEXT, author_name TEXT, author_id TEXT, "
+                "content TEXT, server_id TEXT, channel_id TEXT"))
+
+def _schema_1(conn):
+    """The archive's tables, keyed so that rows can be inserted blindly.
+    Tables made before the schema was versioned are rebuilt with keys,
+    dropping duplicate rows."""
+    for table, columns in ARCHIVE_TABLES:
+        info = conn.execute("PRAGMA table_info({})".format(table)).fetchall()
+        if info and not any(column[5] for column in info):
+            conn.execute("ALTER TABLE {0} RENAME TO {0}_old".format(table))
+            conn.execute("CREATE TABLE {} ({})".format(table, columns))
+            conn.execute("INSERT OR IGNORE INTO {0} SELECT * FROM "
+                         "{0}_old".format(table))
+            conn.execute("DROP TABLE {}_old".format(table))
+        else:
+            conn.execute("CREATE TABLE IF NOT EXISTS {} ({})".format(
+                table, columns))
+
+def _schema_2(conn):
+    """Backfill positions"""
+    conn.execute("CREATE TABLE IF NOT EXISTS BACKFILL ("
+                 "channel_id TEXT PRIMARY KEY, oldest_id TEXT, "
+                 "newest_id TEXT, done INTEGER)")
+
+def _schema_3(conn):
+    """Indexes for the queries readers make"""
+    conn.execute("CREATE INDEX IF NOT EXISTS message_author "
+                 "ON MESSAGE (author_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS message_channel_author "
+                 "ON MESSAGE (channel_id, author_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS message_server_time "
+                 "ON MESSAGE (server_id, timestamp)")
+
+def _schema_4(conn):
+    """Word and message counts per server, channel and author, kept up to
+    date by the archiver so readers don't go through MESSAGE. WORDS_BACKFILL
+    is how far the archiver has counted the messages archived before."""
+    conn.execute("CREATE TABLE IF NOT EXISTS WORDS (server_id TEXT, "
+                 "channel_id TEXT, author_id TEXT, word TEXT, count INTEGER, "
+                 "PRIMARY KEY (server_id, channel_id, author_id, word))")
+    conn.execute("CREATE INDEX IF NOT EXISTS words_author "
+                 "ON WORDS (author_id)")
+    conn.execute("CREATE TABLE IF NOT EXISTS MESSAGE_COUNT (server_id TEXT, "
+                 "channel_id TEXT, author_id TEXT, count INTEGER, "
+                 "PRIMARY KEY (server_id, channel_id, author_id))")
+    conn.execute("CREATE INDEX IF NOT EXISTS message_count_author "
+                 "ON MESSAGE_COUNT (author_id)")
+    conn.execute("CREATE TABLE IF NOT EXISTS WORDS_BACKFILL ("
+                 "position INTEGER, target INTEGER)")
+    target = conn.execute("SELECT MAX(rowid) FROM MESSAGE").fetchone()[0]
+    conn.execute("INSERT INTO WORDS_BACKFILL VALUES (0,?)", (target or 0,))
+
+# Applied in order, the database's user_version is how many have run
+MIGRATIONS = (_schema_1, _schema_2, _schema_3, _schema_4)
+
+def migrate(conn):
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for number, migration in enumerate(MIGRATIONS[version:], version + 1):
+        print("Migrating the message database to schema {}...".format(number))
+        with conn:
+            migration(conn)
+            conn.execute("PRAGMA user_version = {}".format(number))
+
 def check_files():
-    if not os.path.isfile(DATABASE_PATH):
-        conn = lite.connect(DATABASE_PATH)
-        c = conn.cursor()
-        #c.execute("CREATE TABLE IF NOT EXISTS servers (Id INT, Name TEXT)")
-        #c.execute("CREATE TABLE IF NOT EXISTS users (Id INT, ServerId INT, Name TEXT, Avatar_Url TEXT)")
-        #c.execute("CREATE TABLE IF NOT EXISTS messages (UserId INT, Message TEXT)")
+    conn = lite.connect(DATABASE_PATH)
+    try:
+        # Readers don't block the archiver, nor it them
+        conn.execute("PRAGMA journal_mode=WAL")
+        migrate(conn)
+    finally:
+        conn.close()
 
 def string(input):
     if input is None:
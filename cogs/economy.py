@@ -2,6 +2,7 @@ import discord
 from discord.ext import commands
 from cogs.utils.dataIO import dataIO
 from collections import namedtuple, defaultdict, deque, OrderedDict
+from itertools import islice
 from datetime import datetime
 from copy import deepcopy
 from .utils import checks
@@ -16,8 +17,10 @@ import asyncio
 from asyncio import Lock
 import sys
 import threading
+import sqlite3
 from PIL import Image
 from random import randint
+from bisect import bisect_left, insort
 
 default_settings = {"PAYDAY_TIME": 300, "PAYDAY_CREDITS": 120,
                     "SLOT_MIN": 5, "SLOT_MAX": 100, "SLOT_TIME": 0,
@@ -34,6 +37,8 @@ multiplier_settings = {"[ 🇯🇴🇧 ] Potato Farmer": 2,
                        "[ 🇯🇴🇧 ] Peek Melon Virtuoso": 30}
 
 TAX_RATE = 0.02
+BANK_PATH = "data/economy/bank.json"
+BANK_DB_PATH = "data/economy/bank.db"
                        
 class EconomyError(Exception):
     pass
@@ -127,11 +132,62 @@ SLOT_PAYOUTS_MSG = ("Slot machine payouts:\n"
                     "Two symbols: 2% of jackpot".format(**SMReel.__dict__))
 
 
+class BalanceIndex:
+    """Accounts sorted by balance, per server and globally
+
+    Kept in step with every balance mutation so leaderboards never
+    have to copy and sort the whole bank"""
+
+    def __init__(self):
+        self._balances = {}  # (server_id, user_id) -> balance
+        self._global = []    # sorted (-balance, server_id, user_id)
+        self._servers = defaultdict(list)  # sorted (-balance, user_id)
+
+    def update(self, server_id, user_id, balance):
+        self.remove(server_id, user_id)
+        self._balances[(server_id, user_id)] = balance
+        insort(self._global, (-balance, server_id, user_id))
+        insort(self._servers[server_id], (-balance, user_id))
+
+    def remove(self, server_id, user_id):
+        balance = self._balances.pop((server_id, user_id), None)
+        if balance is None:
+            return
+        self._discard(self._global, (-balance, server_id, user_id))
+        self._discard(self._servers[server_id], (-balance, user_id))
+
+    def remove_server(self, server_id):
+        for _, user_id in self._servers.pop(server_id, []):
+            del self._balances[(server_id, user_id)]
+        self._global = [k for k in self._global if k[1] != server_id]
+
+    def server_ranking(self, server_id):
+        """Yields (user_id, balance) from the richest account down"""
+        for neg_balance, user_id in self._servers.get(server_id, []):
+            yield user_id, -neg_balance
+
+    def global_ranking(self):
+        """Yields (server_id, user_id, balance) from the richest down"""
+        for neg_balance, server_id, user_id in self._global:
+            yield server_id, user_id, -neg_balance
+
+    def _discard(self, keys, key):
+        i = bisect_left(keys, key)
+        if i < len(keys) and keys[i] == key:
+            del keys[i]
+
+
 class Bank:
 
     def __init__(self, bot, file_path):
         self.accounts = dataIO.load_json(file_path)
         self.bot = bot
+        self.index = BalanceIndex()
+        for server_id, accounts in self.accounts.items():
+            if "balance" in accounts:  # Legacy account
+                continue
+            for user_id, account in accounts.items():
+                self.index.update(server_id, user_id, account["balance"])
 
     def create_account(self, user, *, initial_balance=0):
         server = user.server
@@ -148,6 +204,7 @@ class Bank:
                        "created_at": timestamp
                        }
             self.accounts[server.id][user.id] = account
+            self.index.update(server.id, user.id, balance)
             self._save_bank()
             return self.get_account(user)
         else:
@@ -170,6 +227,7 @@ class Bank:
         if account["balance"] >= amount:
             account["balance"] -= amount
             self.accounts[server.id][user.id] = account
+            self.index.update(server.id, user.id, account["balance"])
             self._save_bank()
         else:
             raise InsufficientBalance()
@@ -179,6 +237,7 @@ class Bank:
         account = self._get_account(user)
         account["balance"] +=  amount
         self.accounts[server.id][user.id] = account
+        self.index.update(server.id, user.id, account["balance"])
         self._save_bank()
 
     def deposit_credits(self, user, amount):
@@ -188,6 +247,7 @@ class Bank:
         account = self._get_account(user)
         account["balance"] += amount
         self.accounts[server.id][user.id] = account
+        self.index.update(server.id, user.id, account["balance"])
         self._save_bank()
 
     def set_credits(self, user, amount):
@@ -197,6 +257,7 @@ class Bank:
         account = self._get_account(user)
         account["balance"] = amount
         self.accounts[server.id][user.id] = account
+        self.index.update(server.id, user.id, account["balance"])
         self._save_bank()
 
     def transfer_credits(self, sender, receiver, amount):
@@ -222,8 +283,25 @@ class Bank:
 
     def wipe_bank(self, server):
         self.accounts[server.id] = {}
+        self.index.remove_server(server.id)
         self._save_bank()
 
+    def tax_accounts(self, server, rate):
+        """Withdraws int(balance * rate) from every account of the server
+
+        Done in a single pass with a single save. Returns the total
+        amount of credits withdrawn"""
+        total = 0
+        for user_id, account in self.accounts.get(server.id, {}).items():
+            deduction = int(account["balance"] * rate)
+            if deduction:
+                account["balance"] -= deduction
+                self.index.update(server.id, user_id, account["balance"])
+                total += deduction
+        if total:
+            self._save_bank()
+        return total
+
     def get_server_accounts(self, server):
         if server.id in self.accounts:
             raw_server_accounts = deepcopy(self.accounts[server.id])
@@ -285,6 +363,197 @@ class Bank:
             raise NoAccount()
 
 
+class SQLiteBank(Bank):
+    """Bank backed by a SQLite database
+
+    Same public API as Bank, but every mutation only touches the
+    account rows involved instead of rewriting the whole bank file"""
+
+    def __init__(self, bot, db_path):
+        self.bot = bot
+        self.db_path = db_path
+        self.db = sqlite3.connect(db_path)
+        self._create_tables()
+        self.index = BalanceIndex()
+        rows = self.db.execute("SELECT server_id, user_id, balance "
+                               "FROM accounts")
+        for server_id, user_id, balance in rows:
+            self.index.update(server_id, user_id, balance)
+
+    def _create_tables(self):
+        with self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS accounts ("
+                            "server_id TEXT NOT NULL, "
+                            "user_id TEXT NOT NULL, "
+                            "name TEXT, "
+                            "balance NUMERIC NOT NULL DEFAULT 0, "
+                            "created_at TEXT, "
+                            "PRIMARY KEY (server_id, user_id))")
+            # Accounts from the old, server agnostic, bank format
+            self.db.execute("CREATE TABLE IF NOT EXISTS legacy_accounts ("
+                            "user_id TEXT PRIMARY KEY, "
+                            "balance NUMERIC NOT NULL DEFAULT 0)")
+
+    def create_account(self, user, *, initial_balance=0):
+        server = user.server
+        if self.account_exists(user):
+            raise AccountAlreadyExists()
+        row = self.db.execute("SELECT balance FROM legacy_accounts "
+                              "WHERE user_id=?", (user.id,)).fetchone()
+        balance = row[0] if row is not None else initial_balance
+        timestamp = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+        with self.db:
+            self.db.execute("INSERT INTO accounts VALUES (?, ?, ?, ?, ?)",
+                            (server.id, user.id, user.name, balance,
+                             timestamp))
+        self.index.update(server.id, user.id, balance)
+        return self.get_account(user)
+
+    def withdraw_credits(self, user, amount):
+        if amount < 0:
+            raise NegativeValue()
+        with self.db:
+            self._withdraw(user, amount)
+        self._refresh_index(user)
+
+    def add_money(self, user, amount):
+        self._update(user, "balance = balance + ?", amount)
+
+    def deposit_credits(self, user, amount):
+        if amount < 0:
+            raise NegativeValue()
+        self._update(user, "balance = balance + ?", amount)
+
+    def set_credits(self, user, amount):
+        if amount < 0:
+            raise NegativeValue()
+        self._update(user, "balance = ?", amount)
+
+    def transfer_credits(self, sender, receiver, amount):
+        if amount < 0:
+            raise NegativeValue()
+        if sender is receiver:
+            raise SameSenderAndReceiver()
+        if not self.account_exists(receiver):
+            raise NoAccount()
+        # Both updates are committed together or not at all
+        with self.db:
+            self._withdraw(sender, amount)
+            self.db.execute("UPDATE accounts SET balance = balance + ? "
+                            "WHERE server_id=? AND user_id=?",
+                            (amount, receiver.server.id, receiver.id))
+        self._refresh_index(sender)
+        self._refresh_index(receiver)
+
+    def wipe_bank(self, server):
+        with self.db:
+            self.db.execute("DELETE FROM accounts WHERE server_id=?",
+                            (server.id,))
+        self.index.remove_server(server.id)
+
+    def tax_accounts(self, server, rate):
+        deduction = "CAST(balance * ? AS INTEGER)"
+        with self.db:
+            total = self.db.execute("SELECT TOTAL(" + deduction + ") "
+                                    "FROM accounts WHERE server_id=?",
+                                    (rate, server.id)).fetchone()[0]
+            self.db.execute("UPDATE accounts SET balance = balance - " +
+                            deduction + " WHERE server_id=?",
+                            (rate, server.id))
+        self.index.remove_server(server.id)
+        rows = self.db.execute("SELECT user_id, balance FROM accounts "
+                               "WHERE server_id=?", (server.id,))
+        for user_id, balance in rows:
+            self.index.update(server.id, user_id, balance)
+        return int(total)
+
+    def get_server_accounts(self, server):
+        rows = self.db.execute("SELECT user_id, name, balance, created_at "
+                               "FROM accounts WHERE server_id=?",
+                               (server.id,))
+        return [self._row_to_account(server, row) for row in rows]
+
+    def get_all_accounts(self):
+        accounts = []
+        rows = self.db.execute("SELECT server_id, user_id, name, balance, "
+                               "created_at FROM accounts")
+        for server_id, *row in rows:
+            server = self.bot.get_server(server_id)
+            if server is None:
+                # Servers that have since been left will be ignored
+                continue
+            accounts.append(self._row_to_account(server, row))
+        return accounts
+
+    def _row_to_account(self, server, row):
+        user_id, name, balance, created_at = row
+        return self._create_account_obj({"id": user_id, "name": name,
+                                         "balance": balance,
+                                         "created_at": created_at,
+                                         "server": server})
+
+    def _withdraw(self, user, amount):
+        """Must be called inside a transaction"""
+        cur = self.db.execute("UPDATE accounts SET balance = balance - ? "
+                              "WHERE server_id=? AND user_id=? "
+                              "AND balance >= ?",
+                              (amount, user.server.id, user.id, amount))
+        if cur.rowcount == 0:
+            self._get_account(user)  # Raises NoAccount
+            raise InsufficientBalance()
+
+    def _update(self, user, expression, amount):
+        with self.db:
+            cur = self.db.execute("UPDATE accounts SET " + expression +
+                                  " WHERE server_id=? AND user_id=?",
+                                  (amount, user.server.id, user.id))
+        if cur.rowcount == 0:
+            raise NoAccount()
+        self._refresh_index(user)
+
+    def _refresh_index(self, user):
+        balance = self._get_account(user)["balance"]
+        self.index.update(user.server.id, user.id, balance)
+
+    def _save_bank(self):
+        pass  # Every operation is committed as it happens
+
+    def _get_account(self, user):
+        row = self.db.execute("SELECT name, balance, created_at "
+                              "FROM accounts WHERE server_id=? AND user_id=?",
+                              (user.server.id, user.id)).fetchone()
+        if row is None:
+            raise NoAccount()
+        name, balance, created_at = row
+        return {"name": name, "balance": balance, "created_at": created_at}
+
+
+def migrate_json_bank(json_path, db_path):
+    """Copies every account of a bank.json file into a SQLite bank
+
+    Existing rows with the same server / user are overwritten.
+    The json file is left untouched. Returns the number of
+    migrated accounts"""
+    data = dataIO.load_json(json_path)
+    accounts = []
+    legacy = []
+    for key, value in data.items():
+        if "balance" in value:  # Old format: user_id -> account
+            legacy.append((key, value["balance"]))
+            continue
+        for user_id, acc in value.items():
+            accounts.append((key, user_id, acc.get("name"),
+                             acc.get("balance", 0), acc.get("created_at")))
+    bank = SQLiteBank(None, db_path)
+    with bank.db:
+        bank.db.executemany("INSERT OR REPLACE INTO accounts "
+                            "VALUES (?, ?, ?, ?, ?)", accounts)
+        bank.db.executemany("INSERT OR REPLACE INTO legacy_accounts "
+                            "VALUES (?, ?)", legacy)
+    bank.db.close()
+    return len(accounts)
+
+
 class SetParser:
     def __init__(self, argument):
         allowed = ("+", "-")
@@ -349,7 +618,10 @@ class Economy:
     def __init__(self, bot):
         global default_settings
         self.bot = bot
-        self.bank = Bank(bot, "data/economy/bank.json")
+        if os.path.isfile(BANK_DB_PATH):
+            self.bank = SQLiteBank(bot, BANK_DB_PATH)
+        else:
+            self.bank = Bank(bot, BANK_PATH)
         self.slot = Slot(bot, "data/economy/slot.json")
         self.file_path = "data/economy/settings.json"
         self.settings = dataIO.load_json(self.file_path)
@@ -600,69 +872,79 @@ class Economy:
             await ctx.invoke(self._server_leaderboard)
 
     @leaderboard.command(name="server", pass_context=True)
-    async def _server_leaderboard(self, ctx, top: int=10):
+    async def _server_leaderboard(self, ctx, top: int=10, page: int=1):
         """Prints out the server's leaderboard
 
-        Defaults to top 10"""
+        Defaults to top 10. Pass a page number to see lower ranks"""
         # Originally coded by Airenkun - edited by irdumb
         server = ctx.message.server
         if top < 1:
             top = 10
-        bank_sorted = sorted(self.bank.get_server_accounts(server),
-                             key=lambda x: x.balance, reverse=True)
-        bank_sorted = [a for a in bank_sorted if a.member] #  exclude users who left
-        if len(bank_sorted) < top:
-            top = len(bank_sorted)
-        topten = bank_sorted[:top]
+        if page < 1:
+            page = 1
+        ranking = ((server.get_member(user_id), balance) for user_id, balance
+                   in self.bank.index.server_ranking(server.id))
+        ranking = ((m, b) for m, b in ranking if m)  # exclude users who left
+        first = (page - 1) * top
+        topten = list(islice(ranking, first, first + top))
         highscore = ""
-        place = 1
-        for acc in topten:
-            highscore += str(place).ljust(len(str(top)) + 1)
-            highscore += (str(acc.member.display_name) + " ").ljust(23 - len(str(acc.balance)))
-            highscore += str(acc.balance) + "\n"
+        place = first + 1
+        width = len(str(first + len(topten)))
+        for member, balance in topten:
+            highscore += str(place).ljust(width + 1)
+            highscore += (str(member.display_name) + " ").ljust(23 - len(str(balance)))
+            highscore += str(balance) + "\n"
             place += 1
         if highscore != "":
             for page in pagify(highscore, shorten_by=12):
                 await self.bot.say(box(page, lang="py"))
+        elif page > 1:
+            await self.bot.say("There are no accounts on that page.")
         else:
             await self.bot.say("There are no accounts in the bank.")
 
     @leaderboard.command(name="global")
-    async def _global_leaderboard(self, top: int=10):
+    async def _global_leaderboard(self, top: int=10, page: int=1):
         """Prints out the global leaderboard
 
-        Defaults to top 10"""
+        Defaults to top 10. Pass a page number to see lower ranks"""
         if top < 1:
             top = 10
-        bank_sorted = sorted(self.bank.get_all_accounts(),
-                             key=lambda x: x.balance, reverse=True)
-        bank_sorted = [a for a in bank_sorted if a.member] #  exclude users who left
-        unique_accounts = []
-        for acc in bank_sorted:
-            if not self.already_in_list(unique_accounts, acc):
-                unique_accounts.append(acc)
-        if len(unique_accounts) < top:
-            top = len(unique_accounts)
-        topten = unique_accounts[:top]
+        if page < 1:
+            page = 1
+        first = (page - 1) * top
+        topten = list(islice(self._global_ranking(), first, first + top))
         highscore = ""
-        place = 1
-        for acc in topten:
-            highscore += str(place).ljust(len(str(top)) + 1)
-            highscore += ("{} |{}| ".format(acc.member, acc.server)
-                          ).ljust(23 - len(str(acc.balance)))
-            highscore += str(acc.balance) + "\n"
+        place = first + 1
+        width = len(str(first + len(topten)))
+        for member, balance in topten:
+            highscore += str(place).ljust(width + 1)
+            highscore += ("{} |{}| ".format(member, member.server)
+                          ).ljust(23 - len(str(balance)))
+            highscore += str(balance) + "\n"
             place += 1
         if highscore != "":
             for page in pagify(highscore, shorten_by=12):
                 await self.bot.say(box(page, lang="py"))
+        elif page > 1:
+            await self.bot.say("There are no accounts on that page.")
         else:
             await self.bot.say("There are no accounts in the bank.")
 
-    def already_in_list(self, accounts, user):
-        for acc in accounts:
-            if user.id == acc.id:
-                return True
-        return False
+    def _global_ranking(self):
+        """Yields (member, balance), richest account of each user only"""
+        seen = set()
+        for server_id, user_id, balance in self.bank.index.global_ranking():
+            if user_id in seen:
+                continue
+            server = self.bot.get_server(server_id)
+            if server is None:
+                continue
+            member = server.get_member(user_id)
+            if member is None:  # exclude users who left
+                continue
+            seen.add(user_id)
+            yield member, balance
 
     @commands.command(pass_context=True, no_pm=True)
     async def dice(self, ctx, bid: int, guess: int):
@@ -1471,6 +1753,28 @@ class Economy:
         await self.bot.say("Registering an account will now give {} credits."
                            "".format(credits))
         dataIO.save_json(self.file_path, self.settings)
+
+    @economyset.command(name="sqlite")
+    @checks.is_owner()
+    async def _sqlite(self):
+        """Moves the bank from bank.json to a SQLite database
+
+        The json file is kept as a backup. This is a one-way switch"""
+        if isinstance(self.bank, SQLiteBank):
+            await self.bot.say("The bank is already using SQLite.")
+            return
+        dataIO.flush(BANK_PATH)
+        try:
+            migrated = migrate_json_bank(BANK_PATH, BANK_DB_PATH)
+        except Exception as e:
+            logger.exception("Bank migration failed", exc_info=e)
+            if os.path.isfile(BANK_DB_PATH):
+                os.remove(BANK_DB_PATH)
+            await self.bot.say("Migration failed. The bank is unchanged.")
+            return
+        self.bank = SQLiteBank(self.bot, BANK_DB_PATH)
+        await self.bot.say("{} accounts have been moved to the SQLite bank."
+                           "".format(migrated))
         
     async def on_message(self, message):
         if message.channel.is_private:
@@ -1490,14 +1794,14 @@ class Economy:
             
         
     def tax(self, server):
-        bank_accounts = self.bank.get_server_accounts(server)
-        
-        for account in bank_accounts:
-            balance = self.bank.get_balance(account)
-            tax_deduction = int(balance * TAX_RATE)
-            #print(tax_deduction)
-            self.bank.withdraw_credits(account, tax_deduction)
-            self.slot.add_to_pot(tax_deduction)        
+        start = time.perf_counter()
+        total = self.bank.tax_accounts(server, TAX_RATE)
+        if total:
+            self.slot.add_to_pot(total)
+        elapsed = (time.perf_counter() - start) * 1000
+        logger.info("Taxed {} credits on server {} in {:.2f}ms"
+                    "".format(total, server.id, elapsed))
+        return total
 
     # What would I ever do without stackoverflow?
     def display_time(self, seconds, granularity=2):
@@ -1557,7 +1861,7 @@ def check_files():
         print("Creating default economy's settings.json...")
         dataIO.save_json(f, {})
 
-    f = "data/economy/bank.json"
+    f = BANK_PATH
     if not dataIO.is_valid_json(f):
         print("Creating empty bank.json...")
         dataIO.save_json(f, {})
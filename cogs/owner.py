@@ -900,6 +900,26 @@ class Owner:
             await self.bot.say("I need the `Embed links` permission "
                                "to send this")
 
+    @commands.command()
+    @checks.is_owner()
+    async def iostats(self):
+        """Shows how many data file writes have been coalesced"""
+        stats = dataIO.get_stats()
+        if not stats:
+            await self.bot.say("No data files have been saved yet.")
+            return
+        mode = ("write-behind every {}s".format(dataIO.write_behind)
+                if dataIO.write_behind else "write-through")
+        msg = "Mode: {}\n\n".format(mode)
+        msg += "{:<45} {:>7} {:>7} {:>9}\n".format("File", "Saves",
+                                                    "Writes", "Coalesced")
+        for filename, s in sorted(stats.items(),
+                                  key=lambda x: x[1]["saves"], reverse=True):
+            msg += "{:<45} {:>7} {:>7} {:>9}\n".format(
+                filename[-45:], s["saves"], s["writes"], s["coalesced"])
+        for page in pagify(msg, ["\n"], shorten_by=16):
+            await self.bot.say(box(page))
+
     @commands.command(pass_context=True)
     @checks.is_owner()
     async def traceback(self, ctx, public: bool=False):
@@ -958,6 +978,8 @@ class Owner:
             self.bot.unload_extension(cogname)
         except:
             raise CogUnloadError
+        finally:
+            dataIO.flush()
 
     def _list_cogs(self):
         cogs = [os.path.basename(f) for f in glob.glob("cogs/*.py")]
@@ -3,6 +3,7 @@ from random import choice
 from .utils.dataIO import dataIO
 from .utils import checks
 from .utils.chat_formatting import box
+from .utils import mixer
 import logging
 import collections
 import discord
@@ -10,14 +11,33 @@ import time
 import copy
 import os
 import asyncio
-import uuid
+import hashlib
+import io
+import subprocess
+import tempfile
 import chardet
 import re
 from gtts import gTTS
 from enum import Enum
+from json import JSONDecodeError
+from concurrent.futures import ThreadPoolExecutor
 
 log = logging.getLogger("red.tts")
 
+SYNTH_WORKERS = 4
+TTS_CACHE_PATH = "data/tts/cache"
+TTS_CACHE_MAX = 64 * 1024 * 1024  # bytes
+SETTINGS_PATH = "data/tts/settings.json"
+SOUNDBOARD_PATH = "data/soundboard"
+CLIP_CACHE_MAX = 32 * 1024 * 1024  # bytes of decoded PCM, ~3 minutes
+MAX_LOOKAHEAD = 10
+TTS_CHUNK_SIZE = 100  # characters, gTTS makes one request per 100
+
+PUNCTUATION = re.escape("¡!()[]¿?.,،;:—。、：？！\n")
+# A run of text with the punctuation that ends it, or leading punctuation
+TOKEN_PATTERN = re.compile(r"[^{0}]+[{0}]*|[{0}]+".format(PUNCTUATION))
+EMOJI_PATTERN = re.compile(r'(\<:).+(:\d+>)')
+
 available_languages = { 'af' : 'Afrikaans', 
                         'sq' : 'Albanian', 
                         'ar' : 'Arabic',
@@ -85,18 +105,216 @@ class QueueKey(Enum):
     TTS_LANGUAGE = 10
     SB_ENABLED = 11
 
+class TTSCache:
+    """Synthesized speech on disk, keyed by language and text with its
+    whitespace normalized
+
+    The least recently used files are evicted once the cache grows past
+    max_bytes. Access times are kept in the files' mtimes, so the order
+    survives restarts."""
+
+    def __init__(self, path, max_bytes=TTS_CACHE_MAX):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.files = collections.OrderedDict()  # name: size, oldest first
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.rescan()
+
+    @staticmethod
+    def normalize(text):
+        # Case is kept, gTTS spells out acronyms
+        return " ".join(text.split())
+
+    def filename(self, lang, text):
+        key = "{}\n{}".format(lang, text).encode("utf-8")
+        name = hashlib.sha1(key).hexdigest() + ".mp3"
+        return os.path.join(self.path, name)
+
+    def rescan(self):
+        entries = []
+        for name in os.listdir(self.path):
+            if not name.endswith(".mp3"):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.path, name))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, name, stat.st_size))
+        entries.sort()
+        self.files.clear()
+        self.size = 0
+        for _, name, size in entries:
+            self.files[name] = size
+            self.size += size
+
+    def lookup(self, lang, text):
+        """Returns the cached file for text, or None"""
+        filename = self.filename(lang, text)
+        name = os.path.basename(filename)
+        if name in self.files:
+            try:
+                os.utime(filename)
+            except OSError:  # Removed behind our back
+                self.size -= self.files.pop(name)
+            else:
+                self.files.move_to_end(name)
+                self.hits += 1
+                return filename
+        self.misses += 1
+        return None
+
+    def add(self, filename, keep=()):
+        name = os.path.basename(filename)
+        try:
+            size = os.path.getsize(filename)
+        except OSError:
+            return
+        self.size -= self.files.pop(name, 0)
+        self.files[name] = size
+        self.size += size
+        self.evict(keep)
+
+    def evict(self, keep=()):
+        """Removes the oldest files, except those in keep, until under
+        max_bytes"""
+        for name in list(self.files):
+            if self.size <= self.max_bytes:
+                break
+            filename = os.path.join(self.path, name)
+            if filename in keep:
+                continue
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+            self.size -= self.files.pop(name)
+
+
+class Soundboard:
+    """The soundboard registry, reloaded only when its file changes, with
+    its clips decoded ahead of time to the PCM a stream player takes"""
+
+    def __init__(self, loop, executor, settings_path, folder,
+                 max_bytes=CLIP_CACHE_MAX):
+        self.loop = loop
+        self.executor = executor
+        self.settings_path = settings_path
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.sounds = {}
+        self.mtime = None
+        self.clips = collections.OrderedDict()  # filename: (mtime, PCM)
+        self.size = 0
+        self._decoding = set()
+
+    def registry(self):
+        try:
+            mtime = os.path.getmtime(self.settings_path)
+        except OSError:
+            return self.sounds
+        if mtime != self.mtime:
+            self.sounds = dataIO.load_json(self.settings_path)
+            self.mtime = mtime
+            self._predecode()
+        return self.sounds
+
+    def filename(self, sound):
+        """The clip's path, or None if there is no such sound"""
+        sounds = self.registry()
+        if sound not in sounds:
+            return None
+        return os.path.join(self.folder, sounds[sound])
+
+    def clip(self, filename):
+        """The decoded clip, or None if it isn't in memory"""
+        if filename not in self.clips:
+            return None
+        self.clips.move_to_end(filename)
+        return self.clips[filename][1]
+
+    def _predecode(self):
+        wanted = {}
+        for name in self.sounds.values():
+            filename = os.path.join(self.folder, name)
+            try:
+                wanted[filename] = os.path.getmtime(filename)
+            except OSError:
+                continue
+        for filename, (mtime, _) in list(self.clips.items()):
+            if wanted.get(filename) != mtime:
+                self._drop(filename)
+        for filename in wanted:
+            self.decode(filename)
+
+    def decode(self, filename):
+        if filename in self.clips or filename in self._decoding:
+            return
+        self._decoding.add(filename)
+        fut = self.loop.run_in_executor(self.executor, self._decode, filename)
+        fut.add_done_callback(lambda f: self._decoded(filename, f))
+
+    def _decode(self, filename):
+        mtime = os.path.getmtime(filename)
+        p = subprocess.Popen(["ffmpeg", "-i", filename, "-f", "s16le",
+                              "-ar", "48000", "-ac", "2", "-loglevel",
+                              "quiet", "pipe:1"],
+                             stdin=subprocess.DEVNULL, stdout=subprocess.PIPE)
+        pcm, _ = p.communicate()
+        if p.returncode != 0:
+            return None
+        return mtime, pcm
+
+    def _decoded(self, filename, fut):
+        self._decoding.discard(filename)
+        if fut.cancelled():
+            return
+        if fut.exception() is not None:
+            log.warning("Couldn't decode {}: {}".format(filename,
+                                                        fut.exception()))
+            return
+        result = fut.result()
+        if result is None or len(result[1]) > self.max_bytes:
+            return
+        while self.clips and self.size + len(result[1]) > self.max_bytes:
+            self._drop(next(iter(self.clips)))
+        self.clips[filename] = result
+        self.size += len(result[1])
+
+    def _drop(self, filename):
+        _, pcm = self.clips.pop(filename)
+        self.size -= len(pcm)
+
+
 class TextToSpeech:
     """General commands."""
     def __init__(self, bot):
         self.bot = bot
         self.local_playlist_path = "data/tts"
         self.local_soundboard_settings = "data/soundboard/sb_settings.json"
+        self.settings = dataIO.load_json(SETTINGS_PATH)
         self.connect_timers = {}
         self.queue = {}
-        self.remove_queue = deque()
         self.user_list = deque()
+        self.synth_executor = ThreadPoolExecutor(max_workers=SYNTH_WORKERS)
+        self.workers = {}  # sid: (synthesis task, playback task)
+        self.slot_freed = {}  # sid: asyncio.Event, set when playback pops
+        self.synth_times = {}  # sid: recent synthesis latencies in seconds
+        self.speech_gaps = {}  # sid: recent silences between utterances
+        self.tts_cache = TTSCache(TTS_CACHE_PATH)
+        self.soundboard = Soundboard(bot.loop, self.synth_executor,
+                                     self.local_soundboard_settings,
+                                     SOUNDBOARD_PATH)
+        self.soundboard.registry()
         self.mp3_remove_all()
 
+    def __unload(self):
+        for tasks in self.workers.values():
+            for task in tasks:
+                task.cancel()
+        self.synth_executor.shutdown(wait=False)
+
     async def on_message(self, message):
         if message.channel.is_private:
             return
@@ -111,7 +329,7 @@ class TextToSpeech:
             return
             
         #print(message.clean_content)
-        regex = re.search(r'(\<:).+(:\d+>)',message.clean_content)
+        regex = EMOJI_PATTERN.search(message.clean_content)
         
         message_content = message.clean_content
         if len(message_content) > 0:
@@ -123,30 +341,35 @@ class TextToSpeech:
                 message_content = message_content.replace(group, "")
             
         if self.queue[sid][QueueKey.TSS_ENABLED] and not message.tts and not message.author.bot:
-            for text in self._tokenize(message_content, 10):
-               
-                if text.strip() != "":
-                    if self.queue[server.id][QueueKey.LAST_MESSAGE_USER] == message.author.id:
-                        self.queue[sid][QueueKey.QUEUE].append(text.strip())
-                    else:
-                        username = message.author.name
-                        self.queue[sid][QueueKey.QUEUE].append(username + " says: " + text.strip())
-                        self.queue[server.id][QueueKey.LAST_MESSAGE_USER] = message.author.id
-                    
-    def _tokenize(self, text, max_size):
-        """ Tokenizer on basic punctuation """
-        
-        punc = "¡!()[]¿?.,،;:—。、：？！\n"
-        punc_list = [re.escape(c) for c in punc]
-        pattern = '|'.join(punc_list)
-        parts = re.split(pattern, text)
+            author = message.author.id
+            for text in self._tokenize(message_content, TTS_CHUNK_SIZE):
+                if self.queue[server.id][QueueKey.LAST_MESSAGE_USER] == author:
+                    self._say(server, text, author=author)
+                else:
+                    username = message.author.name
+                    self._say(server, username + " says: " + text,
+                              author=author)
+                    self.queue[server.id][QueueKey.LAST_MESSAGE_USER] = author
 
-        return parts
+    def _tokenize(self, text, max_size):
+        """Splits text after punctuation, then merges the pieces back into
+        chunks of up to max_size characters. The text is kept as written,
+        only the ends of each chunk are trimmed. Chunks with nothing to
+        say are dropped."""
+        chunks = []
+        current = ""
+        for piece in TOKEN_PATTERN.findall(text):
+            if current.strip() and len((current + piece).strip()) > max_size:
+                chunks.append(current.strip())
+                current = piece
+            else:
+                current += piece
+        chunks.append(current.strip())
+        return [c for c in chunks if any(ch.isalnum() for ch in c)]
                     
     @commands.group(pass_context=True, no_pm=True)
     async def happybirthday(self, ctx):
-        sid = ctx.message.server.id
-        self.queue[sid][QueueKey.QUEUE].append("Happy brithday to you! Happy birthday to you! Happybirthday dear Ricky Leek. Happy Birthday to you!")
+        self._say(ctx.message.server, "Happy brithday to you! Happy birthday to you! Happybirthday dear Ricky Leek. Happy Birthday to you!")
 
     @commands.group(pass_context=True, no_pm=True)
     async def sb(self, ctx, sound):
@@ -158,32 +381,20 @@ class TextToSpeech:
                 await self.sb_off(ctx)
             else:
                 if self.queue[server.id][QueueKey.SB_ENABLED]:
-                    msg = sound
-                    self.local_soundboard_settings
-                    current = dataIO.load_json(self.local_soundboard_settings)
-                    if sound in current.keys():
-                        self.queue[server.id][QueueKey.TEMP_QUEUE].append("data/soundboard/"+current[sound])
+                    filename = self.soundboard.filename(sound)
+                    if filename is not None:
+                        self._play_sound(server, filename)
                     else:
                         msg = box("Soundboard command " + sound + " does not exist.")
                         await self.bot.say(msg)
-                        
-                        cmd_usage = "Usage: sb <sound>\n" + \
-                                    " Available sounds:\n"
-                        current = dataIO.load_json(self.local_soundboard_settings)
-                        for sound in current.keys():
-                            cmd_usage = cmd_usage + "   -" + sound + "\n"
-                        msg = box(cmd_usage)
-                                  
-                        await self.bot.say(msg)
+                        await self.bot.say(self._sb_usage())
         else:
-            cmd_usage = "Usage: sb <sound>\n" + \
-                        " Available sounds:\n"
-            current = dataIO.load_json(self.local_soundboard_settings)
-            for sound in current.keys():
-                cmd_usage = cmd_usage + "   -" + sound + "\n"
-            msg = box(cmd_usage)
-                      
-            await self.bot.say(msg)
+            await self.bot.say(self._sb_usage())
+
+    def _sb_usage(self):
+        lines = ["Usage: sb <sound>", " Available sounds:"]
+        lines.extend("   -" + sound for sound in self.soundboard.registry())
+        return box("\n".join(lines) + "\n")
             
     async def sb_on(self, ctx):
         """Turn on TextToSpeech"""
@@ -258,6 +469,54 @@ class TextToSpeech:
                 msg = box("TextToSpeech is currently disabled")
             await self.bot.say(msg)
 
+    @tts.command(pass_context=True)
+    async def stats(self, ctx):
+        """Shows the synthesis queue and latency for this server"""
+        sid = ctx.message.server.id
+        depth = len(self.queue[sid][QueueKey.QUEUE]) if sid in self.queue else 0
+        times = self.synth_times.get(sid)
+        msg = "Waiting to be synthesized: {}\n".format(depth)
+        if times:
+            avg = 1000 * sum(times) / len(times)
+            msg += ("Synthesis latency over the last {} messages:\n"
+                    "Average: {:.0f} ms, worst: {:.0f} ms".format(
+                        len(times), avg, 1000 * max(times)))
+        else:
+            msg += "Nothing synthesized yet."
+        sb = self.soundboard
+        msg += "\nSoundboard clips in memory: {}/{} ({:.1f} MB)".format(
+            len(sb.clips), len(sb.sounds), sb.size / 1024 / 1024)
+        cache = self.tts_cache
+        lookups = cache.hits + cache.misses
+        if lookups:
+            msg += "\nCache hit rate: {:.0f}% of {} lookups".format(
+                100 * cache.hits / lookups, lookups)
+        msg += "\nCache size: {:.1f} MB, {} phrases".format(
+            cache.size / 1024 / 1024, len(cache.files))
+        gaps = self.speech_gaps.get(sid)
+        msg += "\nLookahead: {}".format(self.settings["LOOKAHEAD"])
+        if gaps:
+            msg += ("\nGap between utterances over the last {}:\n"
+                    "Average: {:.0f} ms, worst: {:.0f} ms".format(
+                        len(gaps), 1000 * sum(gaps) / len(gaps),
+                        1000 * max(gaps)))
+        await self.bot.say(box(msg))
+
+    @tts.command()
+    @checks.is_owner()
+    async def lookahead(self, count: int):
+        """Sets how many utterances are synthesized ahead of playback"""
+        if not 1 <= count <= MAX_LOOKAHEAD:
+            await self.bot.say("Lookahead must be between 1 and {}.".format(
+                MAX_LOOKAHEAD))
+            return
+        self.settings["LOOKAHEAD"] = count
+        dataIO.save_json(SETTINGS_PATH, self.settings)
+        for event in self.slot_freed.values():
+            event.set()
+        await self.bot.say("Up to {} utterances will be synthesized ahead"
+                           " of playback.".format(count))
+
     @tts.command(pass_context=True)
     async def language(self, ctx):
         server = ctx.message.server
@@ -351,9 +610,9 @@ class TextToSpeech:
             return False
         if self.voice_client(server) is None:
             return False
-        if not hasattr(self.voice_client(server), 'audio_player'):
+        if not hasattr(self.voice_client(server), 'tts_player'):
             return False
-        if self.voice_client(server).audio_player.is_done():
+        if self.voice_client(server).tts_player.is_done():
             return False
         return True
         
@@ -387,14 +646,57 @@ class TextToSpeech:
     def _setup_queue(self, server):
         self.queue[server.id] = {QueueKey.REPEAT: False, QueueKey.PLAYLIST: False,
                                  QueueKey.VOICE_CHANNEL_ID: None,
-                                 QueueKey.QUEUE: deque(), QueueKey.TEMP_QUEUE: deque(),
+                                 QueueKey.QUEUE: PlayQueue(loop=self.bot.loop),
+                                 QueueKey.TEMP_QUEUE: PlayQueue(loop=self.bot.loop),
                                  QueueKey.NOW_PLAYING: None, QueueKey.NOW_PLAYING_CHANNEL: None,
                                  QueueKey.LAST_MESSAGE_USER: "",
                                  QueueKey.TSS_ENABLED: False,
                                  QueueKey.LAST_MESSAGE_USER: 0,
                                  QueueKey.TTS_LANGUAGE: "en",
                                  QueueKey.SB_ENABLED: False}
+        # The old workers were bound to the old queues
+        for task in self.workers.pop(server.id, ()):
+            task.cancel()
+        self.slot_freed.pop(server.id, None)
+
+    def _start_workers(self, server):
+        """Starts the tasks consuming a server's queues, if not running"""
+        if server.id in self.workers:
+            return
+        texts = self.queue[server.id][QueueKey.QUEUE]
+        files = self.queue[server.id][QueueKey.TEMP_QUEUE]
+        self.slot_freed[server.id] = asyncio.Event(loop=self.bot.loop)
+        self.workers[server.id] = (
+            self.bot.loop.create_task(
+                self.gTTS_queue_manager(server.id, texts, files)),
+            self.bot.loop.create_task(
+                self.voice_queue_manager(server.id, files)))
+
+    def _say(self, server, text, author=None):
+        if server.id not in self.queue:
+            self._setup_queue(server)
+        self._start_workers(server)
+        texts = self.queue[server.id][QueueKey.QUEUE]
+        last = texts.last()
+        # Consecutive messages from someone are spoken in one go, as long
+        # as the previous one is still waiting to be synthesized
+        if author is not None and last is not None and last[2] == author:
+            merged = last[0]
+            if not merged.endswith(tuple("!?.,;:")):
+                merged += "."
+            merged += " " + text
+            if len(merged) <= TTS_CHUNK_SIZE:
+                texts.replace_last((merged, last[1], author))
+                return
+        # Enqueue times let playback tell a gap from an idle channel
+        texts.put_nowait((text, time.perf_counter(), author))
 
+    def _play_sound(self, server, filename):
+        if server.id not in self.queue:
+            self._setup_queue(server)
+        self._start_workers(server)
+        self.queue[server.id][QueueKey.TEMP_QUEUE].put_nowait(
+            (filename, time.perf_counter()))
 
         
     async def _join_voice_channel(self, channel):
@@ -421,6 +723,7 @@ class TextToSpeech:
 
         voice_client = self.voice_client(server)
 
+        mixer.close_mixer(voice_client)
         await voice_client.disconnect()
         
     def _stop_player(self, server):
@@ -429,8 +732,8 @@ class TextToSpeech:
 
         voice_client = self.voice_client(server)
 
-        if hasattr(voice_client, 'audio_player'):
-            voice_client.audio_player.stop()
+        if hasattr(voice_client, 'tts_player'):
+            voice_client.tts_player.stop()
             
 #    def _stop_downloader(self, server):
 #        if server.id not in self.downloaders:
@@ -451,7 +754,7 @@ class TextToSpeech:
     def voice_client(self, server):
         return self.bot.voice_client_in(server)
         
-    async def _create_ffmpeg_player(self, server, filename, local=False, start_time=None, end_time=None):
+    async def _guarantee_voice_client(self, server):
         """This function will guarantee we have a valid voice client,
             even if one doesn't exist previously."""
         voice_channel_id = self.queue[server.id][QueueKey.VOICE_CHANNEL_ID]
@@ -469,6 +772,7 @@ class TextToSpeech:
             log.debug("valid reconnect channel for sid"
                       " {}, reconnecting...".format(server.id))
             await self._join_voice_channel(to_connect)  # SHIT
+            voice_client = self.voice_client(server)
         elif voice_client.channel.id != voice_channel_id:
             # This was decided at 3:45 EST in #advanced-testing by 26
             self.queue[server.id][QueueKey.VOICE_CHANNEL_ID] = voice_client.channel.id
@@ -476,6 +780,28 @@ class TextToSpeech:
                 server.id))
 
         # Okay if we reach here we definitively have a working voice_client
+        return voice_client
+
+    def _kill_player(self, voice_client):
+        # Only our own, music keeps playing (ducked) underneath
+        if hasattr(voice_client, 'tts_player'):
+            voice_client.tts_player.stop()
+            log.debug("stopped old player")
+
+    async def _create_stream_player(self, server, stream, after=None):
+        """Plays 48kHz stereo PCM from stream, without spawning ffmpeg"""
+        voice_client = await self._guarantee_voice_client(server)
+        self._kill_player(voice_client)
+
+        log.debug("making stream player on sid {}".format(server.id))
+        voice_client.tts_player = mixer.create_stream_source(
+            voice_client, stream, after=after, ducks=True)
+        voice_client.tts_player.volume = 50/100
+
+        return voice_client
+
+    async def _create_ffmpeg_player(self, server, filename, local=False, start_time=None, end_time=None, after=None):
+        voice_client = await self._guarantee_voice_client(server)
 
         if local:
             song_filename = filename
@@ -491,102 +817,132 @@ class TextToSpeech:
         if end_time:
             options += ' -to {} -copyts'.format(end_time)
 
-        try:
-            voice_client.audio_player.process.kill()
-            log.debug("killed old player")
-        except AttributeError:
-            pass
-        except ProcessLookupError:
-            pass
+        self._kill_player(voice_client)
 
         log.debug("making player on sid {}".format(server.id))
         #print(voice_client)
-        voice_client.audio_player = voice_client.create_ffmpeg_player(
-            song_filename, use_avconv=use_avconv, options=options, before_options=before_options)
+        voice_client.tts_player = mixer.create_ffmpeg_source(
+            voice_client, song_filename, use_avconv=use_avconv, options=options,
+            before_options=before_options, after=after, ducks=True)
 
         # Set initial volume
         vol = 50/100#self.get_server_settings(server)['VOLUME'] / 100
-        voice_client.audio_player.volume = vol
+        voice_client.tts_player.volume = vol
 
         return voice_client  # Just for ease of use, it's modified in-place
 
-    async def gTTS_queue_manager(self, sid):
-        server = self.bot.get_server(sid)
-        queue = self.queue[server.id][QueueKey.QUEUE]
-        assert queue is self.queue[server.id][QueueKey.QUEUE]
-        
-        
-        ttsMessage = queue.popleft()
-        tts = gTTS(text=ttsMessage, lang=self.queue[server.id][QueueKey.TTS_LANGUAGE], slow=False)
-        unique_filename = str(uuid.uuid4()) + ".mp3"
-        ttsFileName = os.path.join(self.local_playlist_path, unique_filename)
-        tts.save(ttsFileName)
-            
-        self.queue[server.id][QueueKey.TEMP_QUEUE].append(ttsFileName)
+    def _synthesize(self, text, lang, filename):
+        """Runs in the executor, gTTS blocks on HTTP and on the disk"""
+        tts = gTTS(text=text, lang=lang, slow=False)
+        # Never leave a partial file in the cache. The same text can be
+        # synthesized for several servers at once, each gets its own tmp
+        fd, tmp = tempfile.mkstemp(suffix=".tmp",
+                                   dir=os.path.dirname(filename))
+        os.close(fd)
+        try:
+            tts.save(tmp)
+            os.replace(tmp, filename)
+        except:
+            os.remove(tmp)
+            raise
 
-    async def gTTS_queue_scheduler(self):
-        while self == self.bot.get_cog('TextToSpeech'):
-            tasks = []
-            queue = copy.deepcopy(self.queue)
-            for sid in queue:
-                #print("gTTS:  " + str(queue[sid][QueueKey.QUEUE]))
-                if len(queue[sid][QueueKey.QUEUE]) == 0:
-                    continue
-                # log.debug("scheduler found a non-empty queue"
-                #           " for sid: {}".format(sid))
-                tasks.append(
-                    self.bot.loop.create_task(self.gTTS_queue_manager(sid)))
-            completed = [t.done() for t in tasks]
-            while not all(completed):
-                completed = [t.done() for t in tasks]
-                await asyncio.sleep(0.1)
-            await asyncio.sleep(0.1)
-            
-    async def voice_queue_manager(self, sid):
-        server = self.bot.get_server(sid)
-        queue = self.queue[server.id][QueueKey.TEMP_QUEUE]
-        assert queue is self.queue[server.id][QueueKey.TEMP_QUEUE]
-        
-        if not self.is_playing(server) and (self.queue[server.id][QueueKey.TSS_ENABLED] or self.queue[server.id][QueueKey.SB_ENABLED]):
-            if self.voice_client(server) is None:
-                return
+    def _queued_files(self):
+        """Files waiting to play or playing, which mustn't be evicted"""
+        files = set()
+        for q in self.queue.values():
+            files.update(f for f, _ in q[QueueKey.TEMP_QUEUE])
+            if q[QueueKey.NOW_PLAYING] is not None:
+                files.add(q[QueueKey.NOW_PLAYING])
+        return files
 
-            filename = queue.popleft()
-            print("pop " + filename) 
+    async def gTTS_queue_manager(self, sid, texts, files):
+        """Synthesizes a server's messages in order, sleeping while there
+        are none or while LOOKAHEAD of them are already waiting to play"""
+        slot_freed = self.slot_freed[sid]
+        while True:
+            text, queued_at, _ = await texts.get()
+            ttsMessage = TTSCache.normalize(text)
+            if not ttsMessage:
+                continue
+            lang = self.queue[sid][QueueKey.TTS_LANGUAGE]
+            ttsFileName = self.tts_cache.lookup(lang, ttsMessage)
+            if ttsFileName is not None:
+                files.put_nowait((ttsFileName, queued_at))
+                continue
 
-            voice_client = await self._create_ffmpeg_player(server, filename, local=True, start_time=None, end_time=None)
-            print("create voice client")
-            voice_client.audio_player.start()
-            print("start voice client")
-            self.remove_queue.append(filename)
-            #os.remove(os.path.join(self.local_playlist_path, filename))
+            while len(files) >= self.settings["LOOKAHEAD"]:
+                slot_freed.clear()
+                await slot_freed.wait()
 
-    async def voice_queue_scheduler(self):
-        while self == self.bot.get_cog('TextToSpeech'):
-            tasks = []
-            queue = copy.deepcopy(self.queue)
-            for sid in queue:
-                #print("voice: " + str(queue[sid][QueueKey.TEMP_QUEUE]))
-                if len(queue[sid][QueueKey.TEMP_QUEUE]) == 0:
-                    self.mp3_cleanup()
+            ttsFileName = self.tts_cache.filename(lang, ttsMessage)
+            start = time.perf_counter()
+            try:
+                await self.bot.loop.run_in_executor(
+                    self.synth_executor, self._synthesize, ttsMessage,
+                    lang, ttsFileName)
+            except Exception:
+                log.exception("gTTS failed on sid {}".format(sid))
+                continue
+            times = self.synth_times.setdefault(
+                sid, collections.deque(maxlen=50))
+            times.append(time.perf_counter() - start)
+
+            self.tts_cache.add(ttsFileName, keep=self._queued_files())
+            files.put_nowait((ttsFileName, queued_at))
+
+    async def voice_queue_manager(self, sid, files):
+        """Plays a server's files in order, waking when one is queued or
+        when the previous one ends"""
+        slot_freed = self.slot_freed[sid]
+        gaps = self.speech_gaps.setdefault(sid, collections.deque(maxlen=50))
+        ended = None
+        while True:
+            filename, queued_at = await files.get()
+            slot_freed.set()
+            server = self.bot.get_server(sid)
+            if server is None:
+                continue
+            if not (self.queue[sid][QueueKey.TSS_ENABLED] or
+                    self.queue[sid][QueueKey.SB_ENABLED]):
+                continue
+            finished = asyncio.Event(loop=self.bot.loop)
+
+            def after():
+                self.bot.loop.call_soon_threadsafe(finished.set)
+
+            # Only silence someone was waiting through counts as a gap
+            if ended is not None and queued_at < ended:
+                gaps.append(time.perf_counter() - ended)
+
+            # Kept out of the cache's eviction until it has played
+            self.queue[sid][QueueKey.NOW_PLAYING] = filename
+            try:
+                pcm = self.soundboard.clip(filename)
+                # Both reconnect if the voice client was lost
+                try:
+                    if pcm is not None:
+                        voice_client = await self._create_stream_player(
+                            server, io.BytesIO(pcm), after=after)
+                    else:
+                        voice_client = await self._create_ffmpeg_player(
+                            server, filename, local=True, after=after)
+                except VoiceNotConnected:
+                    log.warning("Not connected on sid {} and no channel to"
+                                " reconnect to, skipping {}".format(
+                                    sid, filename))
                     continue
-                # log.debug("scheduler found a non-empty queue"
-                #           " for sid: {}".format(sid))
-                tasks.append(
-                    self.bot.loop.create_task(self.voice_queue_manager(sid)))
-            completed = [t.done() for t in tasks]
-            while not all(completed):
-                completed = [t.done() for t in tasks]
-                await asyncio.sleep(0.1)
-            await asyncio.sleep(0.1)
-            
-    def mp3_cleanup(self):
-        if len(self.remove_queue) > 1:
-            file_to_remove = self.remove_queue.popleft()
-            if self.local_playlist_path in file_to_remove:
-                os.remove(file_to_remove)
+                except Exception:
+                    log.exception("Couldn't play {} on sid {}".format(
+                        filename, sid))
+                    continue
+                voice_client.tts_player.start()
+                await finished.wait()
+            finally:
+                self.queue[sid][QueueKey.NOW_PLAYING] = None
+            ended = time.perf_counter()
 
     def mp3_remove_all(self):
+        """Removes one-off files left behind by older versions"""
         for file in os.listdir(self.local_playlist_path):
             if file.endswith(".mp3"):
                 os.remove(os.path.join(self.local_playlist_path, file))
@@ -605,6 +961,23 @@ class TextToSpeech:
             await asyncio.sleep(5)
 
         
+class PlayQueue(asyncio.Queue):
+    """An asyncio.Queue whose pending items can be looked at"""
+
+    def __len__(self):
+        return self.qsize()
+
+    def __iter__(self):
+        return iter(self._queue)
+
+    def last(self):
+        """The most recently queued item still waiting, or None"""
+        return self._queue[-1] if self._queue else None
+
+    def replace_last(self, item):
+        self._queue[-1] = item
+
+
 class deque(collections.deque):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -625,6 +998,9 @@ class NotConnected(Exception):
 class AuthorNotConnected(NotConnected):
     pass
 
+class VoiceNotConnected(NotConnected):
+    pass
+
 class UnauthorizedConnect(Exception):
     pass    
     
@@ -638,13 +1014,31 @@ class ConnectTimeout(NotConnected):
     pass
   
 def check_folders():
-    folders = ("data", "data/tts", "data/soundboard")
+    folders = ("data", "data/tts", TTS_CACHE_PATH, "data/soundboard")
     for folder in folders:
         if not os.path.exists(folder):
             print("Creating " + folder + " folder...")
             os.makedirs(folder)
             
 def check_files():
+    tts_default = {"LOOKAHEAD": 2}
+    if not os.path.isfile(SETTINGS_PATH):
+        print("Creating default tts settings.json...")
+        dataIO.save_json(SETTINGS_PATH, tts_default)
+    else:
+        try:
+            current = dataIO.load_json(SETTINGS_PATH)
+        except JSONDecodeError:
+            dataIO.save_json(SETTINGS_PATH, tts_default)
+            current = dataIO.load_json(SETTINGS_PATH)
+        if current.keys() != tts_default.keys():
+            for key in tts_default.keys():
+                if key not in current.keys():
+                    current[key] = tts_default[key]
+                    print("Adding " + str(key) +
+                          " field to tts settings.json")
+            dataIO.save_json(SETTINGS_PATH, current)
+
     default = {"sample": "sample.mp3"}
     data_path = "data/soundboard/"
     settings_path = "data/soundboard/sb_settings.json"
@@ -671,10 +1065,8 @@ def check_files():
             dataIO.save_json(settings_path, current)
         
 def setup(bot):
-    n = TextToSpeech(bot)
     check_folders()
     check_files()
+    n = TextToSpeech(bot)
     bot.add_cog(n)
-    bot.loop.create_task(n.gTTS_queue_scheduler())
-    bot.loop.create_task(n.disconnect_timer())
-    bot.loop.create_task(n.voice_queue_scheduler())    
+    bot.loop.create_task(n.disconnect_timer())    
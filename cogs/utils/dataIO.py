@@ -1,6 +1,10 @@
+import asyncio
 import json
 import os
 import logging
+import threading
+from collections import defaultdict
+from copy import deepcopy
 from random import randint
 
 class InvalidFileIO(Exception):
@@ -9,30 +13,46 @@ class InvalidFileIO(Exception):
 class DataIO():
     def __init__(self):
         self.logger = logging.getLogger("red")
+        self.write_behind = None     # Flush interval in seconds, None = off
+        self._dirty = {}             # filename -> latest data to be written
+        self._in_flight = {}         # filename -> (version, data) in a write
+        self._versions = defaultdict(int)
+        self._written = defaultdict(int)
+        self._write_lock = threading.Lock()
+        self._flusher = None
+        self.stats = defaultdict(lambda: {"saves": 0, "writes": 0,
+                                          "coalesced": 0})
 
     def save_json(self, filename, data):
-        """Atomically saves json file"""
-        rnd = randint(1000, 9999)
-        path, ext = os.path.splitext(filename)
-        tmp_file = "{}-{}.tmp".format(path, rnd)
-        self._save_json(tmp_file, data)
-        try:
-            self._read_json(tmp_file)
-        except json.decoder.JSONDecodeError:
-            self.logger.exception("Attempted to write file {} but JSON "
-                                  "integrity check on tmp file has failed. "
-                                  "The original file is unaltered."
-                                  "".format(filename))
-            return False
-        os.replace(tmp_file, filename)
+        """Atomically saves json file
+
+        In write-behind mode the file is only marked as dirty and
+        will be written by the background flusher"""
+        self.stats[filename]["saves"] += 1
+        self._versions[filename] += 1
+        if self.write_behind is None or not self._exists(filename):
+            # New files are written right away so os.path.isfile checks
+            # keep working as expected
+            self._dirty.pop(filename, None)
+            version = self._versions[filename]
+            return self._write(filename, self._serialize(data), version)
+        if filename in self._dirty:
+            self.stats[filename]["coalesced"] += 1
+        self._dirty[filename] = data
         return True
 
     def load_json(self, filename):
         """Loads json file"""
+        if filename in self._dirty:
+            return deepcopy(self._dirty[filename])
+        if filename in self._in_flight:
+            return deepcopy(self._in_flight[filename][1])
         return self._read_json(filename)
 
     def is_valid_json(self, filename):
         """Verifies if json file exists / is readable"""
+        if filename in self._dirty or filename in self._in_flight:
+            return True
         try:
             self._read_json(filename)
             return True
@@ -52,6 +72,120 @@ class DataIO():
                 separators=(',',' : '))
         return data
 
+    def _serialize(self, data):
+        return json.dumps(data, indent=4, sort_keys=True,
+                          separators=(',',' : '))
+
+    def _exists(self, filename):
+        return (filename in self._dirty or filename in self._in_flight or
+                os.path.isfile(filename))
+
+    def _write(self, filename, text, version):
+        """Writes an already serialized document through a tmp file
+
+        Thread safe. A write is skipped if a newer version of the
+        file has already made it to disk"""
+        with self._write_lock:
+            if self._written[filename] >= version:
+                return True
+            rnd = randint(1000, 9999)
+            path, ext = os.path.splitext(filename)
+            tmp_file = "{}-{}.tmp".format(path, rnd)
+            with open(tmp_file, encoding='utf-8', mode="w") as f:
+                f.write(text)
+            try:
+                self._read_json(tmp_file)
+            except json.decoder.JSONDecodeError:
+                self.logger.exception("Attempted to write file {} but JSON "
+                                      "integrity check on tmp file has "
+                                      "failed. The original file is "
+                                      "unaltered.".format(filename))
+                return False
+            os.replace(tmp_file, filename)
+            self._written[filename] = version
+            self.stats[filename]["writes"] += 1
+            return True
+
+    def _pop_dirty(self, filename=None):
+        """Serializes and unmarks dirty files
+
+        They're kept in flight, where loads still find them, until
+        _finish_write is called. Must be called from the thread that
+        mutates the data (the event loop) so that the snapshot is
+        consistent"""
+        if filename is None:
+            filenames = list(self._dirty)
+        elif filename in self._dirty:
+            filenames = [filename]
+        else:
+            filenames = []
+        pending = []
+        for f in filenames:
+            data = self._dirty.pop(f)
+            version = self._versions[f]
+            self._in_flight[f] = (version, data)
+            pending.append((f, data, self._serialize(data), version))
+        return pending
+
+    def _finish_write(self, filename, data, version, written):
+        """Takes a file out of flight. One whose write failed is marked
+        dirty again, unless it was saved since"""
+        if self._in_flight.get(filename, (None,))[0] == version:
+            del self._in_flight[filename]
+        if written:
+            return
+        if filename not in self._dirty and self._versions[filename] == version:
+            self._dirty[filename] = data
+
+    def flush(self, filename=None):
+        """Synchronously writes pending files to disk
+
+        If filename is None every dirty file is flushed"""
+        for f, data, text, version in self._pop_dirty(filename):
+            written = False
+            try:
+                written = self._write(f, text, version)
+            finally:
+                self._finish_write(f, data, version, written)
+
+    def enable_write_behind(self, loop, interval=2.0):
+        """Enables write-behind mode
+
+        save_json will only mark files as dirty and a background task
+        running on loop will write each of them at most once per interval"""
+        if interval <= 0:
+            raise ValueError("The flush interval must be positive.")
+        self.write_behind = interval
+        if self._flusher is None or self._flusher.done():
+            self._flusher = loop.create_task(self._flush_loop(loop))
+
+    def disable_write_behind(self):
+        """Disables write-behind mode and flushes all pending files"""
+        self.write_behind = None
+        if self._flusher is not None:
+            self._flusher.cancel()
+            self._flusher = None
+        self.flush()
+
+    def get_stats(self):
+        """Returns per-file write statistics"""
+        return {f: dict(s) for f, s in self.stats.items()}
+
+    async def _flush_loop(self, loop):
+        while self.write_behind is not None:
+            await asyncio.sleep(self.write_behind)
+            pending = self._pop_dirty()
+            for f, data, text, version in pending:
+                try:
+                    written = await loop.run_in_executor(None, self._write,
+                                                         f, text, version)
+                except Exception as e:
+                    self.logger.exception("Write-behind flush of {} failed, "
+                                          "retrying on the next one"
+                                          "".format(f), exc_info=e)
+                    written = False
+                self._finish_write(f, data, version, written)
+
     def _legacy_fileio(self, filename, IO, data=None):
         """Old fileIO provided for backwards compatibility"""
         if IO == "save" and data != None:
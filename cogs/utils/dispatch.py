@@ -0,0 +1,115 @@
+from collections import namedtuple, OrderedDict
+
+# prefix: the prefix the message starts with
+# alias: what the alias named by the first word runs, or None
+# customcom: the custom command's text, or None
+Dispatch = namedtuple("Dispatch", "prefix alias customcom")
+
+RECENT_MESSAGES = 64  # classifications kept for the other listeners
+
+
+class PrefixTrie:
+    """Finds the prefix a text starts with in one pass over it
+
+    Like discord.py, the first matching prefix in the given order wins,
+    not necessarily the longest."""
+
+    def __init__(self, prefixes):
+        self.root = {}
+        for index, prefix in enumerate(prefixes):
+            node = self.root
+            for char in prefix:
+                node = node.setdefault(char, {})
+            node.setdefault(None, (index, prefix))  # None is never a character
+
+    def match(self, text):
+        node = self.root
+        found = node.get(None)
+        for char in text:
+            node = node.get(char)
+            if node is None:
+                break
+            if None in node and (found is None or node[None] < found):
+                found = node[None]
+        return found[1] if found is not None else None
+
+
+class DispatchTable:
+    """A server's prefixes, aliases and custom commands, compiled"""
+
+    def __init__(self, prefixes, aliases, customcoms):
+        self.prefixes = list(prefixes)
+        self.trie = PrefixTrie(prefixes)
+        self.aliases = dict(aliases)  # name: command it runs
+        self.customcoms = dict(customcoms)  # name: text
+
+    def classify(self, content):
+        prefix = self.trie.match(content)
+        if prefix is None:
+            return None
+        rest = content[len(prefix):]
+        alias = self.aliases.get(rest.split(" ")[0].lower())
+        customcom = self.customcoms.get(rest)
+        if customcom is None:
+            customcom = self.customcoms.get(rest.lower())
+        return Dispatch(prefix, alias, customcom)
+
+
+class Dispatcher:
+    """Classifies each message once for the bot and the cogs listening to it
+
+    A table is compiled per server on first use, and again whenever the
+    server's prefixes differ from the ones it was compiled with. Cogs
+    provide their names with register() and call invalidate() whenever
+    they change them, so the table is rebuilt on the next message."""
+
+    def __init__(self, get_prefixes):
+        self.get_prefixes = get_prefixes
+        self.providers = {}  # kind: callable(server_id) -> {name: value}
+        self._tables = {}  # server id, None outside servers: DispatchTable
+        self._recent = OrderedDict()  # (message id, content): Dispatch
+
+    def register(self, kind, provider):
+        """provider(server_id) returns the server's {name: value} of kind,
+        either "aliases" or "customcoms" """
+        self.providers[kind] = provider
+        self.invalidate()
+
+    def unregister(self, kind):
+        self.providers.pop(kind, None)
+        self.invalidate()
+
+    def invalidate(self, server_id=None):
+        """Drops the server's table, or every table if server_id is None"""
+        if server_id is None:
+            self._tables.clear()
+        else:
+            self._tables.pop(server_id, None)
+        self._recent.clear()
+
+    def table(self, server):
+        server_id = server.id if server is not None else None
+        prefixes = self.get_prefixes(server)
+        table = self._tables.get(server_id)
+        if table is None or table.prefixes != prefixes:
+            names = {}
+            if server_id is not None:
+                for kind, provider in self.providers.items():
+                    names[kind] = provider(server_id)
+            table = DispatchTable(prefixes,
+                                  names.get("aliases", {}),
+                                  names.get("customcoms", {}))
+            self._tables[server_id] = table
+            self._recent.clear()
+        return table
+
+    def classify(self, message):
+        """Returns the message's Dispatch, or None if it has no prefix"""
+        key = (message.id, message.content)
+        if key in self._recent:
+            return self._recent[key]
+        dispatch = self.table(message.server).classify(message.content)
+        self._recent[key] = dispatch
+        if len(self._recent) > RECENT_MESSAGES:
+            self._recent.popitem(last=False)
+        return dispatch
@@ -0,0 +1,246 @@
+import audioop
+import inspect
+import logging
+import queue
+import shlex
+import subprocess
+import threading
+
+log = logging.getLogger("red.mixer")
+
+FRAME_SIZE = 3840  # 20ms of 48kHz 16-bit stereo, what the encoder takes
+DUCK_VOLUME = 0.3  # Volume of the other sources while a ducking one plays
+BUFFER_FRAMES = 50  # Frames read ahead from each process, one second
+SILENCE = b"\0" * FRAME_SIZE
+
+
+class Source:
+    """A PCM stream playing through a voice client's mixer
+
+    It has the same start/stop/pause/resume/is_done/is_playing/volume
+    interface as discord.py's players, so cogs can keep using it as their
+    audio_player. The after callback is called once, from whichever thread
+    ends the source.
+
+    A process' output is read by a thread of its own into a buffer of
+    BUFFER_FRAMES, so one that is slow to start or stalls doesn't hold
+    up the mixer. Other streams are read directly."""
+
+    def __init__(self, mixer, stream, after=None, process=None, ducks=False):
+        self.mixer = mixer
+        self.stream = stream
+        self.after = after
+        self.process = process
+        self.ducks = ducks
+        self.volume = 1.0
+        self._started = False
+        self._paused = False
+        self._done = False
+        self._lock = threading.Lock()
+        self._frames = None
+        if process is not None:
+            self._frames = queue.Queue(maxsize=BUFFER_FRAMES)
+            self._reader = threading.Thread(target=self._read_stream,
+                                            daemon=True)
+
+    def start(self):
+        self._started = True
+        if self._frames is not None:
+            self._reader.start()
+        self.mixer.add(self)
+
+    def stop(self):
+        with self._lock:
+            if self._done:
+                return
+            self._done = True
+        self.mixer.remove(self)
+        if self.process is not None:
+            try:
+                self.process.kill()
+            except ProcessLookupError:
+                pass
+            # Not communicate(), the reader thread may still be on stdout
+            self.process.wait()
+        self._call_after()
+
+    def pause(self):
+        self._paused = True
+        self.mixer.update()
+
+    def resume(self):
+        self._paused = False
+        self.mixer.update()
+
+    def is_playing(self):
+        return self._started and not self._paused and not self._done
+
+    def is_done(self):
+        return self._done
+
+    def read(self):
+        """Returns the next frame, b"" if none is ready yet, or None once
+        the stream is exhausted"""
+        if self._frames is None:
+            return self._read_frame()
+        try:
+            return self._frames.get_nowait()
+        except queue.Empty:
+            return b""
+
+    def _read_frame(self):
+        try:
+            data = self.stream.read(FRAME_SIZE)
+        except (OSError, ValueError):  # Closed by stop()
+            return None
+        if not data:
+            return None
+        if len(data) < FRAME_SIZE:
+            data = data.ljust(FRAME_SIZE, b"\0")
+        return data
+
+    def _read_stream(self):
+        """Runs in the reader thread until the stream ends or the source
+        is stopped, None marks the end in the buffer"""
+        while not self._done:
+            frame = self._read_frame()
+            while not self._done:
+                try:
+                    self._frames.put(frame, timeout=0.5)
+                except queue.Full:  # Paused, or the mixer is behind
+                    continue
+                break
+            if frame is None:
+                return
+
+    def _call_after(self):
+        if self.after is None:
+            return
+        try:
+            arg_count = len(inspect.signature(self.after).parameters)
+        except (TypeError, ValueError):
+            arg_count = 0
+        try:
+            if arg_count == 0:
+                self.after()
+            else:
+                self.after(self)
+        except:
+            log.exception("Exception in the after callback of a source")
+
+
+class Mixer:
+    """Mixes every source playing on a voice client into a single stream
+    player, so the connection keeps one encoder and one sending thread
+
+    The stream player is started when the first source is added and lives
+    until close() is called on disconnect. It's paused while no source is
+    playing, rather than sending silence. While a ducking source plays,
+    the others are turned down to DUCK_VOLUME."""
+
+    def __init__(self, voice_client):
+        self.voice_client = voice_client
+        self.sources = []
+        self.player = None
+        self._lock = threading.Lock()
+
+    def add(self, source):
+        with self._lock:
+            self.sources.append(source)
+            if self.player is None or self.player.is_done():
+                self.player = self.voice_client.create_stream_player(self)
+                self.player.start()
+        self.update()
+
+    def remove(self, source):
+        with self._lock:
+            if source in self.sources:
+                self.sources.remove(source)
+        self.update()
+
+    def update(self):
+        """Pauses the stream player while no source is playing"""
+        with self._lock:
+            if self.player is None:
+                return
+            if any(not s._paused for s in self.sources):
+                if not self.player.is_playing():
+                    self.player.resume()
+            elif self.player.is_playing():
+                self.player.pause()
+
+    def close(self):
+        """Stops every source and the stream player"""
+        with self._lock:
+            sources = list(self.sources)
+            player, self.player = self.player, None
+        for source in sources:
+            source.stop()
+        if player is not None:
+            player.stop()
+
+    def read(self, size):
+        """Called by the stream player's thread for every frame"""
+        with self._lock:
+            sources = [s for s in self.sources if not s._paused]
+        ducking = any(s.ducks for s in sources)
+        mixed = None
+        for source in sources:
+            try:
+                frame = source.read()
+            except Exception:
+                log.exception("Couldn't read from a mixer source")
+                frame = None
+            if frame is None:
+                source.stop()
+                continue
+            if not frame:  # Nothing buffered yet, it's silent this frame
+                continue
+            volume = source.volume
+            if ducking and not source.ducks:
+                volume *= DUCK_VOLUME
+            if volume != 1.0:
+                frame = audioop.mul(frame, 2, min(volume, 2.0))
+            mixed = frame if mixed is None else audioop.add(mixed, frame, 2)
+        if mixed is None:
+            mixed = SILENCE
+        return mixed
+
+
+def get_mixer(voice_client):
+    """The voice client's mixer, created on first use"""
+    mixer = getattr(voice_client, "mixer", None)
+    if mixer is None:
+        mixer = voice_client.mixer = Mixer(voice_client)
+    return mixer
+
+
+def close_mixer(voice_client):
+    """Stops the voice client's mixer, call it before disconnecting"""
+    mixer = getattr(voice_client, "mixer", None)
+    if mixer is not None:
+        mixer.close()
+
+
+def create_ffmpeg_source(voice_client, filename, *, use_avconv=False,
+                         before_options=None, options=None, after=None,
+                         ducks=False):
+    """Like voice_client.create_ffmpeg_player, but plays through the mixer"""
+    command = "avconv" if use_avconv else "ffmpeg"
+    args = [command]
+    if isinstance(before_options, str):
+        args.extend(shlex.split(before_options))
+    args.extend(("-i", filename, "-f", "s16le", "-ar", "48000", "-ac", "2",
+                 "-loglevel", "warning"))
+    if isinstance(options, str):
+        args.extend(shlex.split(options))
+    args.append("pipe:1")
+    process = subprocess.Popen(args, stdin=subprocess.DEVNULL,
+                               stdout=subprocess.PIPE)
+    return Source(get_mixer(voice_client), process.stdout, after=after,
+                  process=process, ducks=ducks)
+
+
+def create_stream_source(voice_client, stream, *, after=None, ducks=False):
+    """Plays 48kHz 16-bit stereo PCM from a file-like object"""
+    return Source(get_mixer(voice_client), stream, after=after, ducks=ducks)
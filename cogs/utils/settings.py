@@ -87,6 +87,11 @@ class Settings:
         parser.add_argument("--debug",
                             action="store_true",
                             help="Enables debug mode")
+        parser.add_argument("--write-behind",
+                            type=float, default=None, metavar="SECONDS",
+                            help="Coalesces data file writes, flushing "
+                                 "each changed file at most once every "
+                                 "SECONDS seconds")
 
         args = parser.parse_args()
 
@@ -105,6 +110,7 @@ class Settings:
         self._no_cogs = args.no_cogs
         self.debug = args.debug
         self._dry_run = args.dry_run
+        self.write_behind = args.write_behind
         self.co_owners = args.co_owner
 
         self.save_settings()
@@ -7,79 +7,356 @@ matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 import numpy as np
 import os
-from urllib import request
+import aiohttp
+import asyncio
+import hashlib
+import multiprocessing
+import time
+from collections import OrderedDict
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from PIL import Image
 from io import BytesIO 
 
 DATABASE_PATH = "data/database/data.db"
 WORDCLOUD_PATH = "data/wordcloud/"
+MAX_WORDS = 200  # WordCloud's own default
+RENDER_WORKERS = 2
+CACHE_PATH = WORDCLOUD_PATH + "cache/"
+CACHE_MEMORY_MAX = 16 * 1024 * 1024  # bytes of PNG kept in memory
+CACHE_DISK_MAX = 128 * 1024 * 1024  # bytes of PNG kept on disk
+RERENDER_AFTER = 25  # new messages before a cached cloud is stale
+MASK_SIZE = 512  # pixels, avatars are downscaled to fit
+MASK_CACHE_SIZE = 64  # masks kept in memory
+
+
+class AvatarUnavailable(Exception):
+    pass
+
+
+def make_mask(data):
+    """Turns avatar image bytes into a downscaled mask array"""
+    img = Image.open(BytesIO(data))
+    img.thumbnail((MASK_SIZE, MASK_SIZE))
+    return np.array(img)
+
+
+def render_cloud(frequencies, width=800, height=400, background_color="black",
+                 mask=None):
+    """Returns the cloud as PNG bytes, runs in a worker process"""
+    wc = WordCloud(width=width, height=height, mask=mask,
+                   background_color=background_color, max_words=MAX_WORDS)
+    wc.generate_from_frequencies(frequencies)
+    buffer = BytesIO()
+    wc.to_image().save(buffer, format="png")
+    return buffer.getvalue()
+
+
+def render_pool():
+    """Worker processes are spawned, not forked, so they don't inherit
+    the locks of the bot's threads"""
+    try:
+        return ProcessPoolExecutor(
+            max_workers=RENDER_WORKERS,
+            mp_context=multiprocessing.get_context("spawn"))
+    except TypeError:  # No mp_context before Python 3.7
+        return ProcessPoolExecutor(max_workers=RENDER_WORKERS)
+
+
+class RenderCache:
+    """Rendered clouds, kept in memory and on disk with LRU eviction
+
+    Each cloud is stored with the number of archived messages it was
+    made from, its watermark. It's served until RERENDER_AFTER more
+    messages have been archived. On disk the key's hash and the
+    watermark make up the file name, so the cache survives restarts."""
+
+    def __init__(self, path, executor, memory_max=CACHE_MEMORY_MAX,
+                 disk_max=CACHE_DISK_MAX):
+        self.path = path
+        self.executor = executor
+        self.memory_max = memory_max
+        self.disk_max = disk_max
+        self.memory = OrderedDict()  # key hash: (watermark, png)
+        self.memory_size = 0
+        self.disk = OrderedDict()  # key hash: (watermark, size)
+        self.disk_size = 0
+        self.hits = 0
+        self.misses = 0
+        self._scan()
+
+    @staticmethod
+    def hash_key(key):
+        return hashlib.sha1(repr(key).encode("utf-8")).hexdigest()
+
+    def _filename(self, key_hash, watermark):
+        return os.path.join(self.path, "{}_{}.png".format(key_hash, watermark))
+
+    def _scan(self):
+        entries = []
+        for name in os.listdir(self.path):
+            key_hash, _, rest = name.partition("_")
+            if not rest.endswith(".png"):
+                continue
+            stat = os.stat(os.path.join(self.path, name))
+            entries.append((stat.st_mtime, key_hash, int(rest[:-4]),
+                            stat.st_size))
+        for _, key_hash, watermark, size in sorted(entries):
+            self.disk[key_hash] = (watermark, size)
+            self.disk_size += size
+
+    async def get(self, key, watermark):
+        """The PNG bytes if a fresh enough render is cached, else None"""
+        key_hash = self.hash_key(key)
+        if key_hash in self.memory:
+            cached, png = self.memory[key_hash]
+            if watermark - cached < RERENDER_AFTER:
+                self.memory.move_to_end(key_hash)
+                self.hits += 1
+                return png
+        elif key_hash in self.disk:
+            cached, _ = self.disk[key_hash]
+            if watermark - cached < RERENDER_AFTER:
+                filename = self._filename(key_hash, cached)
+                try:
+                    png = await asyncio.get_event_loop().run_in_executor(
+                        self.executor, self._read, filename)
+                except OSError:
+                    pass
+                else:
+                    self.disk.move_to_end(key_hash)
+                    self._remember(key_hash, cached, png)
+                    self.hits += 1
+                    return png
+        self.misses += 1
+        return None
+
+    def put(self, key, watermark, png):
+        key_hash = self.hash_key(key)
+        self._remember(key_hash, watermark, png)
+        old = self.disk.pop(key_hash, None)
+        if old is not None:
+            self.disk_size -= old[1]
+            self.executor.submit(self._remove,
+                                 self._filename(key_hash, old[0]))
+        self.disk[key_hash] = (watermark, len(png))
+        self.disk_size += len(png)
+        self.executor.submit(self._write, self._filename(key_hash, watermark),
+                             png)
+        while self.disk_size > self.disk_max and len(self.disk) > 1:
+            evicted, (cached, size) = self.disk.popitem(last=False)
+            self.disk_size -= size
+            self.executor.submit(self._remove,
+                                 self._filename(evicted, cached))
+
+    def _remember(self, key_hash, watermark, png):
+        old = self.memory.pop(key_hash, None)
+        if old is not None:
+            self.memory_size -= len(old[1])
+        self.memory[key_hash] = (watermark, png)
+        self.memory_size += len(png)
+        while self.memory_size > self.memory_max and len(self.memory) > 1:
+            _, (_, evicted) = self.memory.popitem(last=False)
+            self.memory_size -= len(evicted)
+
+    @staticmethod
+    def _read(filename):
+        with open(filename, "rb") as f:
+            os.utime(filename)
+            return f.read()
+
+    @staticmethod
+    def _write(filename, png):
+        with open(filename, "wb") as f:
+            f.write(png)
+
+    @staticmethod
+    def _remove(filename):
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
+
 
 class Wordcloud:
     """General commands."""
     def __init__(self, bot):
         self.bot = bot
-        self.database = lite.connect(DATABASE_PATH)
+        # One connection, only ever used from the reader thread
+        self.database = lite.connect(DATABASE_PATH, check_same_thread=False)
+        self.reader = ThreadPoolExecutor(max_workers=1)
+        self.renderers = render_pool()
+        self.cache = RenderCache(CACHE_PATH, self.reader)
+        self.session = aiohttp.ClientSession(loop=self.bot.loop)
+        self.masks = OrderedDict()  # avatar hash: mask array
     
-    @commands.command(pass_context=True)
+    def __unload(self):
+        self.reader.submit(self.database.close)
+        self.reader.shutdown(wait=False)
+        self.renderers.shutdown(wait=False)
+        self.bot.loop.create_task(self.session.close())
+
+    def _frequencies(self, where, args):
+        """Top words from the WORDS table the database cog maintains"""
+        c = self.database.cursor()
+        sql_cmd = ("SELECT word, SUM(count) AS total FROM WORDS WHERE {} "
+                   "GROUP BY word ORDER BY total DESC LIMIT ?".format(where))
+        return dict(c.execute(sql_cmd, args + (MAX_WORDS,)))
+
+    def _watermark(self, where, args):
+        """How many archived messages a cloud is made from, from the
+        counts the database cog maintains"""
+        c = self.database.cursor()
+        sql_cmd = ("SELECT COALESCE(SUM(count), 0) FROM MESSAGE_COUNT "
+                   "WHERE {}".format(where))
+        return c.execute(sql_cmd, args).fetchone()[0]
+
+    def _words_progress(self):
+        """How much of the older messages' words the database cog has
+        counted, or None once it's done"""
+        c = self.database.cursor()
+        row = c.execute("SELECT position, target FROM "
+                        "WORDS_BACKFILL").fetchone()
+        if row is None or row[0] >= row[1]:
+            return None
+        return row[0] / row[1]
+
+    @staticmethod
+    def _progress_note(progress):
+        if progress is None:
+            return ""
+        return ("\nOlder messages are still being counted ({:.0%} done), "
+                "so this is incomplete.".format(progress))
+
+    async def _render(self, key, where, args, get_mask=None, **options):
+        """Returns the PNG as a buffer, or None if there are no words, and
+        the words' progress from _words_progress
+
+        The cached render for key is used unless enough messages were
+        archived since. Clouds made before every word is counted aren't
+        cached. get_mask is only awaited when rendering."""
+        loop = self.bot.loop
+        progress = await loop.run_in_executor(self.reader,
+                                              self._words_progress)
+        watermark = await loop.run_in_executor(
+            self.reader, self._watermark, where, args)
+        if progress is None:
+            png = await self.cache.get(key, watermark)
+            if png is not None:
+                return BytesIO(png), progress
+
+        frequencies = await loop.run_in_executor(
+            self.reader, self._frequencies, where, args)
+        if not frequencies:
+            return None, progress
+        if get_mask is not None:
+            options["mask"] = await get_mask()
+        png = await loop.run_in_executor(
+            self.renderers, partial(render_cloud, frequencies, **options))
+        if progress is None:
+            self.cache.put(key, watermark, png)
+        return BytesIO(png), progress
+
+    @commands.command(pass_context=True, no_pm=True)
     async def wordcloud(self, ctx):
         server = ctx.message.server
         author = ctx.message.author
         channel = ctx.message.channel
-        self.database = lite.connect(DATABASE_PATH)
-        
-        c = self.database.cursor()
-        wordcloud_text = ""
-        sql_cmd = "SELECT content FROM MESSAGE WHERE author_id=? AND channel_id=?"
-        for row in c.execute(sql_cmd, (author.id, channel.id,)):
-            wordcloud_text = wordcloud_text + row[0].replace("wordcloud","") + " "
         
-        wordcloud = WordCloud(width=800, height=400).generate(wordcloud_text)
+        image, progress = await self._render(
+            ("wordcloud", server.id, channel.id, author.id),
+            "server_id=? AND channel_id=? AND author_id=?",
+            (server.id, channel.id, author.id,))
+        if image is None:
+            await self.bot.say("I don't have enough of your messages here"
+                               " yet." + self._progress_note(progress))
+            return
         
-        temp_wordcloud_file = WORDCLOUD_PATH+str(author.id)+".png"    
-        wordcloud.to_file(temp_wordcloud_file,)
-        
-        await self.bot.say(author.mention)
-        await self.bot.upload(temp_wordcloud_file)
+        await self.bot.upload(image, filename="wordcloud.png",
+                              content=author.mention +
+                              self._progress_note(progress))
                 
     @commands.command(pass_context=True)
     async def mycloud(self, ctx):
         server = ctx.message.server
         author = ctx.message.author
-        self.database = lite.connect(DATABASE_PATH)
         
-        c = self.database.cursor()
-        wordcloud_text = ""
-        sql_cmd = "SELECT content FROM MESSAGE WHERE author_id=?"
-        for row in c.execute(sql_cmd, (author.id,)):
-            wordcloud_text = wordcloud_text + row[0] + " "
+        # The avatar's hash stands for the mask
+        try:
+            image, progress = await self._render(
+                ("mycloud", author.id, author.avatar), "author_id=?",
+                (author.id,), get_mask=lambda: self._avatar_mask(author),
+                background_color="white")
+        except (AvatarUnavailable, aiohttp.ClientError) as e:
+            await self.bot.say("I couldn't download your avatar ({}), try "
+                               "again later.".format(e))
+            return
+        note = self._progress_note(progress)
+        if image is None:
+            await self.bot.say("I don't have enough of your messages yet." +
+                               note)
+            return
             
+        await self.bot.upload(image, filename="mycloud.png",
+                              content=note.lstrip() or None)
+
+    async def _avatar_mask(self, author):
+        """The author's avatar as a mask, fetched and processed only once
+        per avatar"""
         avatar_url = author.avatar_url
         if avatar_url == "":
             avatar_url = author.default_avatar_url
-        print(avatar_url)
-        avatar_path = WORDCLOUD_PATH + str(author.id)+"_avatar.webp"
-        req = request.Request(avatar_url, headers={'User-Agent': 'Mozilla/5.0'})
-
-        with request.urlopen(req) as url:
-            with open(avatar_path, 'wb') as f:
-                f.write(url.read())
-                f.close()
+        avatar_hash = author.avatar or avatar_url
+        if avatar_hash in self.masks:
+            self.masks.move_to_end(avatar_hash)
+            return self.masks[avatar_hash]
+
+        async with self.session.get(
+                avatar_url, headers={'User-Agent': 'Mozilla/5.0'}) as r:
+            if r.status != 200:
+                raise AvatarUnavailable("HTTP {}".format(r.status))
+            data = await r.read()
+        mask = await self.bot.loop.run_in_executor(None, make_mask, data)
         
-        file = BytesIO(request.urlopen(req).read())
-        img = Image.open(file)
+        self.masks[avatar_hash] = mask
+        if len(self.masks) > MASK_CACHE_SIZE:
+            self.masks.popitem(last=False)
+        return mask
         
-        mask = np.array(img)#Image.open(avatar_path))
+    @commands.command(pass_context=True, no_pm=True)
+    async def servercloud(self, ctx):
+        """Word cloud of everyone's messages in this server"""
+        server = ctx.message.server
+        image, progress = await self._render(("servercloud", server.id),
+                                             "server_id=?", (server.id,))
+        note = self._progress_note(progress)
+        if image is None:
+            await self.bot.say("I don't have enough messages from this"
+                               " server yet." + note)
+            return
         
-        temp_wordcloud_file = WORDCLOUD_PATH+str(author.id)+".png"    
-        wc = WordCloud(background_color="white", mask=mask)
-        wc.generate(wordcloud_text)
+        await self.bot.upload(image, filename="servercloud.png",
+                              content=note.lstrip() or None)
         
-        wordcloud.to_file(temp_wordcloud_file)
+    @commands.command(pass_context=True, no_pm=True)
+    async def channelcloud(self, ctx):
+        """Word cloud of everyone's messages in this channel"""
+        server = ctx.message.server
+        channel = ctx.message.channel
+        image, progress = await self._render(
+            ("channelcloud", server.id, channel.id),
+            "server_id=? AND channel_id=?", (server.id, channel.id,))
+        note = self._progress_note(progress)
+        if image is None:
+            await self.bot.say("I don't have enough messages from this"
+                               " channel yet." + note)
+            return
         
-        await self.bot.upload(temp_wordcloud_file)
+        await self.bot.upload(image, filename="channelcloud.png",
+                              content=note.lstrip() or None)
         
 def check_folders():
-    folders = ("data", WORDCLOUD_PATH)
+    folders = ("data", WORDCLOUD_PATH, CACHE_PATH)
     for folder in folders:
         if not os.path.exists(folder):
             print("Creating " + folder + " folder...")
@@ -87,4 +364,4 @@ def check_folders():
         
 def setup(bot):
     check_folders()
-    bot.add_cog(Wordcloud(bot))
\ No newline at end of file
+    bot.add_cog(Wordcloud(bot))
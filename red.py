@@ -10,6 +10,7 @@ import subprocess
 
 try:
     from discord.ext import commands
+    from discord.ext.commands.view import StringView
     import discord
 except ImportError:
     print("Discord.py is not installed.\n"
@@ -20,6 +21,7 @@ except ImportError:
 
 from cogs.utils.settings import Settings
 from cogs.utils.dataIO import dataIO
+from cogs.utils.dispatch import Dispatcher
 from cogs.utils.chat_formatting import inline
 from collections import Counter
 from io import TextIOWrapper
@@ -58,6 +60,7 @@ class Bot(commands.Bot):
         self.uptime = datetime.datetime.utcnow()  # Refreshed before login
         self._message_modifiers = []
         self.settings = Settings()
+        self.dispatch_table = Dispatcher(self.settings.get_prefixes)
         self._intro_displayed = False
         self._shutdown_mode = None
         self.logger = set_logger(self)
@@ -91,6 +94,42 @@ class Bot(commands.Bot):
 
         return await super().send_message(*args, **kwargs)
 
+    async def process_commands(self, message):
+        """Same as discord.py's, but the prefix is found in the dispatch
+        table that Alias and CustomCommands also classify messages with,
+        instead of trying every prefix in turn"""
+        # bot.say and friends look these up in the caller's frames
+        _internal_channel = message.channel
+        _internal_author = message.author
+
+        if self._skip_check(message.author, self.user):
+            return
+
+        dispatch = self.dispatch_table.classify(message)
+        if dispatch is None:
+            return
+
+        view = StringView(message.content)
+        view.skip_string(dispatch.prefix)
+        invoker = view.get_word()
+        ctx = commands.Context(bot=self, invoked_with=invoker,
+                               message=message, view=view,
+                               prefix=dispatch.prefix)
+
+        if invoker in self.commands:
+            command = self.commands[invoker]
+            self.dispatch('command', command, ctx)
+            try:
+                await command.invoke(ctx)
+            except commands.CommandError as e:
+                ctx.command.dispatch_error(e, ctx)
+            else:
+                self.dispatch('command_completion', command, ctx)
+        elif invoker:
+            exc = commands.CommandNotFound('Command "{}" is not found'
+                                           ''.format(invoker))
+            self.dispatch('command_error', exc, ctx)
+
     async def shutdown(self, *, restart=False):
         """Gracefully quits Red with exit code 0
 
@@ -98,6 +137,7 @@ class Bot(commands.Bot):
         The launcher automatically restarts Red when that happens"""
         self._shutdown_mode = not restart
         await self.logout()
+        dataIO.flush()
 
     def add_message_modifier(self, func):
         """
@@ -584,6 +624,8 @@ def main(bot):
     check_folders()
     if not bot.settings.no_prompt:
         interactive_setup(bot.settings)
+    if bot.settings.write_behind:
+        dataIO.enable_write_behind(bot.loop, bot.settings.write_behind)
     load_cogs(bot)
 
     if bot.settings._dry_run:
@@ -634,6 +676,7 @@ if __name__ == '__main__':
                              exc_info=e)
         loop.run_until_complete(bot.logout())
     finally:
+        dataIO.disable_write_behind()
         loop.close()
         if bot._shutdown_mode is True:
             exit(0)